@@ -0,0 +1,27 @@
+"""pytest configuration for the qemu based tests
+
+To run the tests against several VMs in parallel, install pytest-xdist
+(python3-pytest-xdist) and pass "-n auto"; the number of VMs is then sized
+from the host CPUs and available memory, and each worker runs its VMs from
+its own overlays of the shared pool."""
+
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+import os
+import sys
+
+import pytest
+
+# share the overlay pool with scripts/run-qemu.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import qemupool  # noqa: E402
+
+# guest RAM of the VMs of qemu_test.py, in MiB
+VM_MEMORY = 2048
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_auto_num_workers(config):
+    """Number of workers, hence of concurrent VMs, for "-n auto" """
+    return qemupool.max_instances(VM_MEMORY)
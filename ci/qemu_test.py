@@ -5,59 +5,82 @@
 
 import os
 import signal
-import subprocess
 import sys
-import tempfile
 
 import pexpect
 import pytest
 
+# on the path thanks to conftest.py
+import qemupool
+
+
+def qemu_command(overlay):
+    """The QEMU command line to run a VM with the qcow2 overlay as its disk"""
+    return [
+        "qemu-system-aarch64",
+        "-cpu",
+        "cortex-a57",
+        "-m",
+        "2048",
+        "-M",
+        "virt",
+        "-drive",
+        f"if=none,file={overlay},format=qcow2,id=disk1,cache=unsafe",
+        "-device",
+        "virtio-scsi-pci,id=scsi1",
+        "-device",
+        "scsi-hd,bus=scsi1.0,drive=disk1,physical_block_size=4096,logical_block_size=4096",
+        "-nographic",
+        "-bios",
+        "/usr/share/AAVMF/AAVMF_CODE.fd",
+    ]
+
+
+@pytest.fixture(scope="session")
+def vm_pool(tmp_path_factory):
+    """A pool of CoW overlays of disk-ufs.img with the state of the VM at its
+    first login prompt; the image is only booted once per session, or once
+    for as long as it doesn't change if QEMU_POOL_DIR is set. With
+    pytest-xdist, the workers share the pool and its first boot, and each
+    of them locks its own overlay while its VM runs"""
+    pool_dir = os.environ.get("QEMU_POOL_DIR")
+    if not pool_dir and "PYTEST_XDIST_WORKER" in os.environ:
+        # the parent of the worker base temporary directories is the same
+        # for all the workers of a run
+        pool_dir = tmp_path_factory.getbasetemp().parent / "qemu-pool"
+    elif not pool_dir:
+        pool_dir = tmp_path_factory.mktemp("qemu-pool")
+    pool = qemupool.OverlayPool(
+        pool_dir,
+        os.path.join(os.getcwd(), "disk-ufs.img"),
+        qemu_command,
+        # This takes a minute or two on a ThinkPad T14s Gen 6 Snapdragon, and
+        # emulated aarch64 (no KVM) on a loaded CI runner is slow
+        boot_timeout=420,
+        log=sys.stdout.buffer,
+    )
+    pool.ensure_golden()
+    return pool
+
 
 @pytest.fixture
-def vm():
-    """A pexpect.spawn object attached to the serial console of a VM freshly
-    booting with a CoW base of disk-ufs.img"""
-    with tempfile.TemporaryDirectory() as tmpdir:
-        qcow_path = os.path.join(tmpdir, "disk1.qcow")
-        subprocess.run(
-            [
-                "qemu-img",
-                "create",
-                "-b",
-                os.path.join(os.getcwd(), "disk-ufs.img"),
-                "-f",
-                "qcow",
-                "-F",
-                "raw",
-                qcow_path,
-            ],
-            check=True,
-        )
+def vm(vm_pool):
+    """A pexpect.spawn object attached to the serial console of a VM restored
+    at its first login prompt, with a CoW base of disk-ufs.img that no other
+    test sees"""
+    with vm_pool.acquire() as overlay:
+        command = qemu_command(overlay) + ["-loadvm", qemupool.SNAPSHOT]
         child = pexpect.spawn(
-            "qemu-system-aarch64",
-            [
-                "-cpu",
-                "cortex-a57",
-                "-m",
-                "2048",
-                "-M",
-                "virt",
-                "-drive",
-                f"if=none,file={qcow_path},format=qcow,id=disk1,cache=unsafe",
-                "-device",
-                "virtio-scsi-pci,id=scsi1",
-                "-device",
-                "scsi-hd,bus=scsi1.0,drive=disk1,physical_block_size=4096,logical_block_size=4096",
-                "-nographic",
-                "-bios",
-                "/usr/share/AAVMF/AAVMF_CODE.fd",
-            ],
+            command[0],
+            command[1:],
             # Emulated aarch64 (no KVM) on a loaded CI runner is slow, so give
-            # every expect() a generous default. The initial boot still
-            # overrides this with a longer per-call timeout below.
+            # every expect() a generous default.
             timeout=120,
         )
         child.logfile = sys.stdout.buffer
+        # The login prompt was printed before the VM state was saved; have
+        # getty print it again
+        child.send("\r\n")
         yield child
 
         # No need to be nice; that would take time
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Assemble the flash_<board>_<storage> directories of the flash recipe from
+# its board table, one record per board with '|' separated fields:
+#   name|soc_id|dtb|dtb_bin_type|boot_binaries_filename|
+#   boot_binaries_sha256|cdt_download_filename|cdt_sha256|
+#   cdt_filename|u_boot_file|platforms
+#
+# Boards are prepared (boot binaries and CDT unpacked, dtb-combineddtb.bin
+# generated) and their flash directories assembled concurrently in a pool of
+# worker threads; files with the same contents are hardlinked to the first
+# copy in the artifacts directory rather than copied again, so must not be
+# modified in place.
+#
+# Archives are only unpacked for the boards which aren't skipped, and once
+# per sha256 into a tree shared by all the boards using them, even under
+# different filenames; build/<board>_boot-binaries links to that tree.
+#
+# Once all boards are done, each flash_<board>_spinor directory is copied
+# into the spinor/ subdirectory of the other storage flash directories of
+# its board listed in its contents.xml, with the paths in its contents.xml
+# and rawprogram*.xml files fixed up to point at the parent directory.
+#
+# Usage:  assemble-flash-dirs.py --boards build/boards.txt \
+#             --targets build/targets.txt --dtbs build/dtbs.txt \
+#             --ptool <qcom-ptool dir> --downloads <dir> [--buildid <id>] \
+#             [--work-dir build] [--jobs N] <artifacts dir>
+
+import argparse
+import fnmatch
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+import xml.etree.ElementTree as ElementTree
+import defusedxml.ElementTree as ET
+
+from hashutil import file_digest
+from linkcopy import Deduplicator, replace_file
+from rawprogram import program_filenames
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# partition files generated by ptool which aren't shipped, as it's common
+# for people to run "qdl rawprogram*.xml" or pcat, mistakingly including
+# these; perhaps ptool should have a flag not to generate these
+PTOOL_EXCLUDE = [
+    "rawprogram*_BLANK_GPT.xml",
+    "rawprogram*_WIPE_PARTITIONS.xml",
+    "wipe_rawprogram*.xml",
+]
+# silicon family boot binaries to ship; these shouldn't ship partition
+# files, but make sure not to accidentally clobber any such file
+BOOT_BINARIES_EXCLUDE = [
+    "gpt_*",
+    "patch*.xml",
+    "rawprogram*.xml",
+    "wipe*.xml",
+    "zeros_*",
+]
+BOOT_BINARIES_INCLUDE = [
+    "LICENSE",
+    "Qualcomm-Technologies-Inc.-Proprietary",
+    "prog_*",
+    "boot.img",
+    "*.bin",
+    "*.elf",
+    "*.melf",
+    "*.fv",
+    "*.mbn",
+]
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message, flush=True)
+
+
+def run(cmd, cwd=None):
+    """
+    Run cmd and print its output in one block, so that the output of
+    concurrent commands isn't interleaved
+    """
+    result = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+    with _print_lock:
+        print(f"Running: {' '.join(str(arg) for arg in cmd)}")
+        sys.stdout.write(result.stdout)
+        sys.stdout.flush()
+    result.check_returncode()
+
+
+def matches(name, patterns):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+class Board:
+    __slots__ = ("name", "soc_id", "dtb", "dtb_bin_type",
+                 "boot_binaries_filename", "boot_binaries_sha256",
+                 "cdt_download_filename", "cdt_sha256", "cdt_filename",
+                 "u_boot_file", "platforms", "boot_binaries_dir", "cdt_dir",
+                 "dtb_bin")
+
+    def __init__(self, line):
+        (self.name, self.soc_id, self.dtb, self.dtb_bin_type,
+         self.boot_binaries_filename, self.boot_binaries_sha256,
+         self.cdt_download_filename, self.cdt_sha256, self.cdt_filename,
+         self.u_boot_file, platforms) = line.rstrip("\n").split("|", 10)
+        self.platforms = platforms.split()
+        self.boot_binaries_dir = None
+        self.cdt_dir = None
+        self.dtb_bin = None
+
+
+def read_boards(boards_table):
+    with open(boards_table, "r", encoding="utf-8") as f:
+        # skip blank lines produced by template whitespace
+        return [Board(line) for line in f if line.split("|", 1)[0].strip()]
+
+
+def read_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class UnpackCache:
+    """
+    Archives unpacked under cache_dir once per sha256; thread-safe, an
+    archive being unpacked for a board is waited for by the other boards
+    using it.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        # unpacked tree by (sha256, strip_top_dir), as [lock, path]
+        self._trees = {}
+
+    def unpack(self, archive, sha256, strip_top_dir=False):
+        """
+        Return the directory archive (a zip or tarball) is unpacked in,
+        without its top directories if strip_top_dir is set
+        """
+        # shouldn't happen as the recipe pins all downloads
+        sha256 = sha256 or file_digest(archive)
+        with self._lock:
+            entry = self._trees.setdefault((sha256, strip_top_dir),
+                                           [threading.Lock(), None])
+        with entry[0]:
+            if entry[1] is not None:
+                log(f"Reusing {entry[1]} for {archive}")
+                return entry[1]
+            tree = self.cache_dir / sha256
+            if strip_top_dir:
+                tree = tree.with_name(f"{sha256}-stripped")
+            unpack_dir = tree / "unpack" if strip_top_dir else tree
+            unpack_dir.mkdir(parents=True)
+            if archive.name.endswith((".tar.gz", ".tgz")):
+                run(["tar", "-xzf", archive, "-C", unpack_dir])
+            else:
+                run(["unzip", "-q", archive, "-d", unpack_dir])
+            if strip_top_dir:
+                for top_dir in unpack_dir.iterdir():
+                    for path in top_dir.iterdir():
+                        path.rename(tree / path.name)
+                    top_dir.rmdir()
+                unpack_dir.rmdir()
+            entry[1] = tree
+            return tree
+
+
+class Assembler:
+    def __init__(self, args):
+        self.artifact_dir = Path(args.artifact_dir).absolute()
+        self.work_dir = Path(args.work_dir).absolute()
+        self.downloads = Path(args.downloads).absolute()
+        self.ptool = os.path.abspath(args.ptool)
+        self.buildid = args.buildid
+        self.targets = read_lines(args.targets)
+        self.dtbs = read_lines(args.dtbs)
+        self.dedup = Deduplicator()
+        self.unpack_cache = UnpackCache(self.work_dir / "unpack")
+        self.dtbs_lock = threading.Lock()
+
+    def skip_reason(self, board):
+        if board.name not in self.targets:
+            return "not in target list"
+        if board.dtb not in self.dtbs:
+            return f"dtb {board.dtb} not available"
+        fit = f"dtb-multidtb-{board.soc_id}.bin"
+        if board.dtb_bin_type == "multidtb" and \
+                not (self.artifact_dir / fit).is_file():
+            return f"multidtb FIT {fit} not available"
+        return None
+
+    def unpack(self, board, filename, sha256, suffix, strip_top_dir=False):
+        """Unpack an archive of board and link build/<board>_<suffix> to it"""
+        tree = self.unpack_cache.unpack(self.downloads / filename, sha256,
+                                        strip_top_dir)
+        board_dir = self.work_dir / f"{board.name}_{suffix}"
+        board_dir.symlink_to(tree, target_is_directory=True)
+        return board_dir
+
+    def unpack_boot_binaries(self, board):
+        # strip top directories
+        return self.unpack(board, board.boot_binaries_filename,
+                           board.boot_binaries_sha256, "boot-binaries",
+                           strip_top_dir=True)
+
+    def unpack_cdt(self, board):
+        # some CDTs ship as .tar.gz, others as .zip
+        return self.unpack(board, board.cdt_download_filename,
+                           board.cdt_sha256, "cdt")
+
+    def make_combineddtb(self, board):
+        """
+        Generate a dtb-combineddtb.bin FAT partition with just the device
+        tree of board, shared by all its flash directories; long-term this
+        should really be a set of dtbs and overlays as to share dtb.bin
+        across boards
+        """
+        dtb_path = self.work_dir / "dtbs" / board.dtb
+        # boards sharing a dtb wait for it to be fully extracted
+        with self.dtbs_lock:
+            if not dtb_path.exists():
+                # extract board device tree from the root filesystem
+                # provided tarball
+                dtb_path.parent.mkdir(parents=True, exist_ok=True)
+                run(["tar", "-C", self.work_dir / "dtbs", "-xf",
+                     self.artifact_dir / "dtbs.tar.gz", board.dtb])
+        dtb_bin = self.work_dir / f"{board.name}_dtb-combineddtb.bin"
+        dtb_bin.unlink(missing_ok=True)
+        # dtb-combineddtb.bin is only used in UFS based boards at the moment
+        # and UFS uses a 4k sector size, so pass -S 4096 in
+        # qcom-ptool/platforms/*/partitions.conf, dtb_a and _b partitions are
+        # provisioned with 64MiB; create a 4MiB FAT that will comfortably fit
+        # in these and hold the target device tree, which is 4096 KiB sized
+        # blocks for mkfs.vfat's last argument
+        run(["mkfs.vfat", "-S", "4096", "-C", dtb_bin, "4096"])
+        # copy into the FAT as combined-dtb.dtb
+        run(["mcopy", "-vmp", "-i", dtb_bin, dtb_path, "::/combined-dtb.dtb"])
+        return dtb_bin
+
+    def prepare_board(self, board):
+        """Unpack the inputs of board; return False if it's skipped"""
+        log(f"Board {board.name}: dtb_bin_type={board.dtb_bin_type}")
+        reason = self.skip_reason(board)
+        if reason:
+            log(f"Skipping board {board.name}: {reason}")
+            return False
+        board.boot_binaries_dir = self.unpack_boot_binaries(board)
+        if board.cdt_download_filename:
+            board.cdt_dir = self.unpack_cdt(board)
+        if board.dtb_bin_type == "combineddtb":
+            board.dtb_bin = self.make_combineddtb(board)
+        return True
+
+    def flash_dirs(self, board):
+        """Return the flash directory of each platform of board"""
+        flash_dirs = {}
+        for platform in board.platforms:
+            # infer storage from ptool platform dir; first strip leading
+            # directory, then strip trailing use case (after first dash)
+            disk_type = platform.split("/", 1)[-1].split("-", 1)[0]
+            flash_dir = self.artifact_dir / f"flash_{board.name}_{disk_type}"
+            # platforms sharing a flash dir overwrite each other, keep the
+            # last one
+            flash_dirs.pop(flash_dir, None)
+            flash_dirs[flash_dir] = (platform, disk_type)
+        return flash_dirs
+
+    def assemble(self, board, platform, disk_type, flash_dir):
+        # generate ptool files - various XML files for flashing, GPT data etc.
+        # they depend on the board (SoC, CDT) and not only on the platform,
+        # so each board gets its own dir
+        ptool_dir = self.work_dir / "ptool" / board.name / platform
+        ptool_dir.mkdir(parents=True, exist_ok=True)
+        run([SCRIPTS_DIR / "gen-ptool.sh", self.ptool, platform,
+             board.cdt_filename, self.buildid, disk_type, board.dtb_bin_type,
+             board.soc_id], cwd=ptool_dir)
+
+        # create board-specific flash directory
+        shutil.rmtree(flash_dir, ignore_errors=True)
+        flash_dir.mkdir()
+        # copy platform partition files
+        for path in sorted(ptool_dir.iterdir()):
+            if not matches(path.name, PTOOL_EXCLUDE):
+                self.dedup.install(path, flash_dir / path.name)
+
+        # copy silicon family boot binaries, flattening subdirectories
+        for root, dirs, files in os.walk(board.boot_binaries_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if matches(name, BOOT_BINARIES_INCLUDE) and \
+                        not matches(name, BOOT_BINARIES_EXCLUDE):
+                    self.dedup.install(os.path.join(root, name),
+                                       flash_dir / name)
+
+        # copy the sail_nor directory (standalone rawprogram/gpt/firehose/elf
+        # payloads) for SAIL domain flashing on SPI-NOR; only some silicon
+        # families ship it
+        sail_nor_dir = board.boot_binaries_dir / "sail_nor"
+        if sail_nor_dir.is_dir():
+            self.dedup.install_tree(sail_nor_dir, flash_dir / "sail_nor")
+
+        if board.u_boot_file:
+            # copy U-Boot binary to boot.img; qcom-ptool partitions.conf
+            # files use filename=boot.img for boot_a and boot_b partitions
+            self.dedup.install(self.artifact_dir / board.u_boot_file,
+                               flash_dir / "boot.img")
+
+        if board.cdt_filename:
+            # copy just the CDT data; no partition or flashing files
+            cdt = board.cdt_dir / board.cdt_filename
+            self.dedup.install(cdt, flash_dir / cdt.name)
+
+        if board.dtb_bin:
+            self.dedup.install(board.dtb_bin,
+                               flash_dir / "dtb-combineddtb.bin")
+        log(f"Assembled {flash_dir} from {platform}")
+
+    def assemble_boards(self, boards, jobs):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = {executor.submit(self.prepare_board, board): board
+                       for board in boards}
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # boards map to None once prepared
+                        board = pending.pop(future)
+                        prepared = future.result()
+                        if board is None or not prepared:
+                            continue
+                        # assemble the flash dirs of the board concurrently
+                        for flash_dir, (platform, disk_type) in \
+                                self.flash_dirs(board).items():
+                            future = executor.submit(
+                                self.assemble, board, platform, disk_type,
+                                flash_dir)
+                            pending[future] = None
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def copy_spinor_dir(self, spinor_dir, storage, target_dir):
+        # copy the spinor flash dir into its parent storage flash dir
+        target_spinor_dir = target_dir / "spinor"
+        self.dedup.install_tree(spinor_dir, target_spinor_dir)
+
+        images = program_filenames(target_dir / "rawprogram0.xml")
+        renames = {
+            "efi.bin": images.get("efi", "none"),
+            "rootfs.img": images.get("rootfs", "none"),
+        }
+
+        # fix file_path (../->../../) then rename efi.bin/rootfs.img
+        contents_xml = target_spinor_dir / "contents.xml"
+        if contents_xml.is_file():
+            tree = parse_xml(contents_xml)
+            changed = False
+            for element in tree.iter():
+                if element.get("storage_type") != storage:
+                    continue
+                for file_name in element.findall("file_name"):
+                    if file_name.text not in renames:
+                        continue
+                    for file_path in element.findall("file_path"):
+                        if file_path.text == "../":
+                            file_path.text = "../../"
+                    file_name.text = renames[file_name.text]
+                    changed = True
+            for element in tree.iter("download_file"):
+                if not any((file_name.text or "").startswith("dtb-multidtb-")
+                           for file_name in element.findall("file_name")):
+                    continue
+                for file_path in element.findall("file_path"):
+                    if file_path.text == "..":
+                        file_path.text = "../../"
+                        changed = True
+            if changed:
+                write_xml(contents_xml, tree)
+
+        # fix rawprogram*.xml in spinor dir:
+        # ../dtb-multidtb-<soc>.bin -> ../../dtb-multidtb-<soc>.bin;
+        # preserve the per-SoC filename by rewriting only the prefix
+        for rawprogram in sorted(target_spinor_dir.rglob("rawprogram*.xml")):
+            tree = parse_xml(rawprogram)
+            changed = False
+            for program in tree.iter("program"):
+                filename = program.get("filename", "")
+                if filename.startswith("../dtb-multidtb-"):
+                    program.set("filename", "../" + filename)
+                    changed = True
+            if changed:
+                write_xml(rawprogram, tree)
+        log(f"Copied {spinor_dir} to {target_spinor_dir}")
+
+    def spinor_copies(self):
+        """
+        Return the storage flash dirs to copy each spinor flash dir into;
+        storage types are read from product_info/chipid in contents.xml
+        """
+        copies = []
+        for spinor_dir in sorted(self.artifact_dir.glob("flash_*_spinor")):
+            contents_xml = spinor_dir / "contents.xml"
+            if not contents_xml.is_file():
+                continue
+            board = spinor_dir.name[len("flash_"):-len("_spinor")]
+            storage_types = {
+                chipid.get("storage_type", "").lower()
+                for product_info in parse_xml(contents_xml).iter(
+                    "product_info")
+                for chipid in product_info.iter("chipid")
+            }
+            for storage in sorted(storage_types - {"", "spinor"}):
+                target_dir = self.artifact_dir / f"flash_{board}_{storage}"
+                if target_dir.is_dir():
+                    copies.append((spinor_dir, storage, target_dir))
+        return copies
+
+    def copy_spinor_dirs(self, jobs):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(self.copy_spinor_dir, *copy)
+                       for copy in self.spinor_copies()]
+            for future in futures:
+                future.result()
+
+
+def parse_xml(path):
+    # keep comments when rewriting files
+    parser = ET.DefusedXMLParser(
+        target=ElementTree.TreeBuilder(insert_comments=True))
+    return ET.parse(path, parser=parser)
+
+
+def write_xml(path, tree):
+    # replace rather than modify the file, which might be hardlinked
+    def write(f):
+        tree.write(f, encoding="utf-8", xml_declaration=True)
+
+    replace_file(path, write)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Assemble the flash directories of the flash recipe")
+    parser.add_argument("--boards", required=True,
+                        help="board table, one '|' separated record per board")
+    parser.add_argument("--targets", required=True,
+                        help="file listing the names of the boards to build")
+    parser.add_argument("--dtbs", required=True,
+                        help="file listing the dtbs in dtbs.tar.gz")
+    parser.add_argument("--ptool", required=True,
+                        help="path to the qcom-ptool tree")
+    parser.add_argument("--downloads", required=True,
+                        help="directory with the downloaded boot binaries "
+                             "and CDTs")
+    parser.add_argument("--buildid", default="",
+                        help="build id for the generated contents.xml")
+    parser.add_argument("--work-dir", default="build",
+                        help="work directory that will be thrown away "
+                             "(default: build)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of boards and platforms to process "
+                             "concurrently (default: number of CPUs)")
+    parser.add_argument("artifact_dir",
+                        help="directory to create the flash directories in")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    assembler = Assembler(args)
+    boards = read_boards(args.boards)
+    try:
+        assembler.assemble_boards(boards, max(1, args.jobs))
+        assembler.copy_spinor_dirs(max(1, args.jobs))
+    except subprocess.CalledProcessError as e:
+        cmd = " ".join(str(arg) for arg in e.cmd)
+        sys.exit(f"Command failed with status {e.returncode}: {cmd}")
+
+    dedup = assembler.dedup
+    print(f"Assembled flash directories in {time.monotonic() - start:.1f}s: "
+          f"{dedup.files_copied} files ({dedup.bytes_copied} bytes) copied, "
+          f"{dedup.files_linked} files ({dedup.bytes_linked} bytes) "
+          f"hardlinked to identical copies")
+
+
+if __name__ == "__main__":
+    main()
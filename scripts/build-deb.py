@@ -4,149 +4,492 @@
 
 # Build a Debian package using sbuild; input is a yaml configuration
 # with base dsc URL, debdiff file to apply and target series
+#
+# Several configurations (or directories of configurations, e.g.
+# overlay-debs/) may be passed at once; packages are then built
+# concurrently, sharing the available CPUs between the sbuild jobs
+#
+# With --cache-dir, downloaded source packages are kept in a local cache
+# keyed by their pinned dsc_sha256sum, so that later builds of the same
+# source don't need any network access
+#
+# With --output-dir, a fingerprint of all the build inputs is stored next to
+# the resulting files; builds whose inputs didn't change since are skipped
+#
+# With --timeline and --chrome-trace, the wall time, CPU time, peak RSS and
+# I/O of each build phase (download, unpack, patch, sbuild...) are recorded
 
 import argparse
+import atexit
 import glob
 import hashlib
+import json
 import os
 import subprocess
+import sys
 import tempfile
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(
-    description="Build a Debian source package with a debdiff."
-)
-parser.add_argument(
-    '--config',
-    type=str,
-    required=True,
-    help='Path to the YAML configuration file'
-)
-parser.add_argument(
-    '--output-dir',
-    type=str,
-    help='Optional directory to preserve resulting files'
-)
-args = parser.parse_args()
-
-# Load configuration from YAML file
-with open(args.config, 'r') as f:
-    config = yaml.safe_load(f)
-
-# Create a temporary directory
-with tempfile.TemporaryDirectory() as temp_dir:
-    # Download the original Debian source package using dget
-    dsc_url = config['dsc_url']
-    subprocess.run(['dget', '-d', dsc_url], cwd=temp_dir, check=True)
-    print("✅ Original source package downloaded successfully.")
-
-    # Determine the .dsc file name
-    dsc_file = os.path.join(temp_dir, os.path.basename(dsc_url))
-
-    # Verify the SHA256 checksum of the .dsc file
-    with open(dsc_file, 'rb') as f:
-        file_data = f.read()
-        sha256sum = hashlib.sha256(file_data).hexdigest()
-
-    expected_sha256 = config['dsc_sha256sum']
-    if sha256sum != expected_sha256:
-        raise ValueError(
-            f"SHA256 checksum does not match!\n"
-            f"Expected: {expected_sha256}\n"
-            f"Actual:   {sha256sum}"
-        )
-    print("✅ Checksum of original source package matched.")
-
-    script = config.get('script')
-    if script:
-        if not os.path.isabs(script):
-            config_dir = os.path.dirname(args.config)
-            script = os.path.abspath(os.path.join(config_dir, script))
-
-        env = os.environ.copy()
-        env['DSC_FILE'] = dsc_file
-        env.update(config.get('env', {}))
-
-        subprocess.run(script, cwd=temp_dir, check=True, env=env)
-
-        print("✅ Successfully executed the script.")
-    else:
-        # Unpack the source package
-        subprocess.run(['dpkg-source', '-x', dsc_file],
-                       cwd=temp_dir,
-                       check=True)
+import buildtrace
+from hashutil import digest_files, file_digest
+
+
+def find_configs(paths):
+    """
+    Expand the list of paths passed on the command-line to a list of YAML
+    configurations; directories are searched recursively.
+    """
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            configs.extend(sorted(
+                glob.glob(os.path.join(path, '**', '*.yaml'), recursive=True)
+            ))
+        else:
+            configs.append(path)
+    return configs
+
+
+def dsc_referenced_files(dsc_file):
+    """
+    Return a list of (sha256, size, filename) tuples for the files listed
+    in the Checksums-Sha256 field of a .dsc.
+    """
+    files = []
+    in_field = False
+    with open(dsc_file, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('Checksums-Sha256:'):
+                in_field = True
+                continue
+            if not in_field:
+                continue
+            # continuation lines of a deb822 field start with a space
+            if not line.startswith(' '):
+                break
+            parts = line.split()
+            if len(parts) == 3:
+                files.append((parts[0], int(parts[1]), parts[2]))
+    return files
+
+
+def cache_fetch(cache_dir, dsc_sha256, dsc_name, dest_dir):
+    """
+    Copy a cached source package to dest_dir; return True on a cache hit.
+    Entries whose files are missing or don't match the checksums from the
+    .dsc are dropped.
+    """
+    entry = os.path.join(cache_dir, dsc_sha256)
+    dsc_file = os.path.join(entry, dsc_name)
+    if not os.path.exists(dsc_file):
+        return False
+    referenced = dsc_referenced_files(dsc_file)
+    digests = digest_files(
+        [os.path.join(entry, name) for _, _, name in referenced])
+    for sha256, _, name in referenced:
+        if digests[os.path.join(entry, name)] != sha256:
+            print(f"⚠️  Dropping corrupted cache entry {entry}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+    names = [dsc_name] + [name for _, _, name in referenced]
+    for name in names:
+        shutil.copy(os.path.join(entry, name), dest_dir)
+    # the mtime of an entry records its last use, for LRU eviction
+    os.utime(entry)
+    return True
+
+
+def cache_store(cache_dir, dsc_sha256, dsc_file):
+    """
+    Add a downloaded and verified source package to the cache.
+    """
+    entry = os.path.join(cache_dir, dsc_sha256)
+    if os.path.exists(entry):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    src_dir = os.path.dirname(dsc_file)
+    names = [os.path.basename(dsc_file)] + [
+        name for _, _, name in dsc_referenced_files(dsc_file)]
+    # populate a private directory and rename it in place, so that
+    # concurrent builds never see a partial entry
+    tmp_entry = tempfile.mkdtemp(prefix=f'.{dsc_sha256}-', dir=cache_dir)
+    for name in names:
+        shutil.copy(os.path.join(src_dir, name), tmp_entry)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another build stored the same source package first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def cache_evict(cache_dir, max_size):
+    """
+    Remove the least recently used entries until the cache is no larger
+    than max_size bytes.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(entry):
+            continue
+        size = sum(
+            os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+        total += size
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        print(f"🗑️  Evicting {entry} from source cache")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def resolve_path(config_dir, path):
+    """Resolve a path from a configuration relative to its directory."""
+    if not path or os.path.isabs(path):
+        return path
+    return os.path.abspath(os.path.join(config_dir, path))
+
+
+def build_fingerprint(config, config_dir):
+    """
+    Return a SHA256 over all the inputs of a build: the pinned .dsc, the
+    contents of the debdiff and script, the script environment and the
+    target suite.
+    """
+    inputs = {
+        'dsc_url': config['dsc_url'],
+        'dsc_sha256sum': config['dsc_sha256sum'],
+        'suite': config['suite'],
+        'env': config.get('env', {}),
+    }
+    for key in ('debdiff_file', 'script'):
+        path = resolve_path(config_dir, config.get(key))
+        if path:
+            inputs[key] = file_digest(path)
+    data = json.dumps(inputs, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def stamp_path(config_path, output_dir):
+    """
+    Return the path of the stamp of config_path in output_dir; the stamp is
+    keyed by the full path of the configuration, as configurations in
+    different directories may have the same name.
+    """
+    name = os.path.splitext(os.path.basename(config_path))[0]
+    key = hashlib.sha256(
+        os.path.abspath(config_path).encode()).hexdigest()[:12]
+    return os.path.join(output_dir, f'.build-deb-{name}-{key}.json')
 
-    # Find the unpacked directory
-    unpacked_dirs = [
-        d for d in os.listdir(temp_dir)
-        if os.path.isdir(os.path.join(temp_dir, d))
-    ]
-    if not unpacked_dirs:
-        raise RuntimeError("No unpacked source directory found.")
-    unpacked_dir = os.path.join(temp_dir, unpacked_dirs[0])
-
-    # Apply the debdiff
-    debdiff_path = config.get('debdiff_file')
-    if debdiff_path:
-        if not os.path.isabs(debdiff_path):
-            config_dir = os.path.dirname(args.config)
-            debdiff_path = os.path.abspath(os.path.join(config_dir,
-                                                        debdiff_path))
-        subprocess.run(
-            ['patch', '-p1', '-i', debdiff_path], cwd=unpacked_dir, check=True)
-        print("✅ Debdiff applied successfully.")
-    else:
-        print("⚠️  No debdiff provided.")
-
-    # Determine number of CPUs for parallel build
+
+def is_up_to_date(stamp_file, fingerprint):
+    """
+    Check whether the stamp left by a previous build has the same
+    fingerprint and all the files it produced are still there.
+    """
+    try:
+        with open(stamp_file, 'r') as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if stamp.get('fingerprint') != fingerprint:
+        return False
+    output_dir = os.path.dirname(stamp_file)
+    return all(os.path.exists(os.path.join(output_dir, name))
+               for name in stamp.get('files', []))
+
+
+def get_num_cpus():
     nproc_result = subprocess.run(
                        ['nproc'], stdout=subprocess.PIPE, text=True,
                        check=True)
-    num_cpus = nproc_result.stdout.strip()
-
-    # Build the resulting source package using sbuild
-    suite = config['suite']
-    subprocess.run(
-        ['sbuild', '--verbose', '-d', suite, '--no-clean-source',
-         '--dpkg-source-opt=--no-check', f'-j{num_cpus}'],
-        cwd=unpacked_dir,
-        check=True
+    return int(nproc_result.stdout.strip())
+
+
+def build_package(config_path, output_dir, num_cpus, cache_dir=None,
+                  force=False):
+    with buildtrace.phase('package', config=config_path):
+        _build_package(config_path, output_dir, num_cpus, cache_dir, force)
+
+
+def _build_package(config_path, output_dir, num_cpus, cache_dir, force):
+    # Load configuration from YAML file
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    config_dir = os.path.dirname(config_path)
+
+    # Skip the build if the results of an identical one are available
+    if output_dir:
+        fingerprint = build_fingerprint(config, config_dir)
+        stamp_file = stamp_path(config_path, output_dir)
+        if not force and is_up_to_date(stamp_file, fingerprint):
+            print(f"✅ {config_path} is up to date, skipping build.")
+            return
+
+    # Create a temporary directory
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dsc_url = config['dsc_url']
+        expected_sha256 = config['dsc_sha256sum']
+
+        # Determine the .dsc file name
+        dsc_file = os.path.join(temp_dir, os.path.basename(dsc_url))
+
+        with buildtrace.phase('fetch', config=config_path):
+            cached = cache_dir and cache_fetch(
+                cache_dir, expected_sha256, os.path.basename(dsc_url),
+                temp_dir)
+            if cached:
+                print("✅ Original source package found in cache.")
+            else:
+                # Download the original Debian source package using dget
+                buildtrace.run(['dget', '-d', dsc_url], cwd=temp_dir,
+                               check=True)
+                print("✅ Original source package downloaded successfully.")
+
+            # Verify the SHA256 checksum of the .dsc file
+            sha256sum = file_digest(dsc_file)
+
+        if sha256sum != expected_sha256:
+            if cached:
+                shutil.rmtree(os.path.join(cache_dir, expected_sha256),
+                              ignore_errors=True)
+            raise ValueError(
+                f"SHA256 checksum does not match!\n"
+                f"Expected: {expected_sha256}\n"
+                f"Actual:   {sha256sum}"
+            )
+        print("✅ Checksum of original source package matched.")
+
+        if cache_dir and not cached:
+            cache_store(cache_dir, expected_sha256, dsc_file)
+
+        script = resolve_path(config_dir, config.get('script'))
+        with buildtrace.phase('unpack', config=config_path):
+            if script:
+                env = os.environ.copy()
+                env['DSC_FILE'] = dsc_file
+                env.update(config.get('env', {}))
+
+                buildtrace.run(script, cwd=temp_dir, check=True, env=env)
+
+                print("✅ Successfully executed the script.")
+            else:
+                # Unpack the source package
+                buildtrace.run(['dpkg-source', '-x', dsc_file],
+                               cwd=temp_dir,
+                               check=True)
+
+        # Find the unpacked directory
+        unpacked_dirs = [
+            d for d in os.listdir(temp_dir)
+            if os.path.isdir(os.path.join(temp_dir, d))
+        ]
+        if not unpacked_dirs:
+            raise RuntimeError("No unpacked source directory found.")
+        unpacked_dir = os.path.join(temp_dir, unpacked_dirs[0])
+
+        # Apply the debdiff
+        debdiff_path = resolve_path(config_dir, config.get('debdiff_file'))
+        if debdiff_path:
+            with buildtrace.phase('patch', config=config_path):
+                buildtrace.run(
+                    ['patch', '-p1', '-i', debdiff_path], cwd=unpacked_dir,
+                    check=True)
+            print("✅ Debdiff applied successfully.")
+        else:
+            print("⚠️  No debdiff provided.")
+
+        # Build the resulting source package using sbuild
+        suite = config['suite']
+        with buildtrace.phase('sbuild', config=config_path):
+            buildtrace.run(
+                ['sbuild', '--verbose', '-d', suite, '--no-clean-source',
+                 '--dpkg-source-opt=--no-check', f'-j{num_cpus}'],
+                cwd=unpacked_dir,
+                check=True
+            )
+        print("✅ Source package built successfully.")
+
+        # Copy results if output-dir is specified
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+            # Find the .changes file
+            changes_files = glob.glob(os.path.join(temp_dir, '*.changes'))
+            if not changes_files:
+                raise RuntimeError(
+                    "No .changes file found to extract artifacts.")
+            changes_file = changes_files[0]
+
+            # Run dcmd to get the list of files
+            result = buildtrace.run(
+                ['dcmd', changes_file],
+                cwd=temp_dir,
+                check=True,
+                stdout=subprocess.PIPE,
+                text=True
+            )
+
+            # Parse the output to get file paths
+            files_to_copy = [
+                line.split()[-1]
+                for line in result.stdout.strip().splitlines()]
+
+            # Add any *.build files
+            build_files = glob.glob(os.path.join(temp_dir, '*.build'))
+            files_to_copy.extend(build_files)
+
+            # Copy files
+            copied = []
+            for file_path in files_to_copy:
+                full_path = os.path.join(temp_dir, file_path)
+                if os.path.exists(full_path):
+                    shutil.copy(full_path, output_dir)
+                    copied.append(os.path.basename(full_path))
+
+            # Record the inputs of this build for later runs
+            with open(stamp_file, 'w') as f:
+                json.dump({'fingerprint': fingerprint, 'files': copied}, f,
+                          indent=2)
+
+            print(f"📦 Results copied to: {output_dir}")
+
+
+def timed_build(config_path, output_dir, num_cpus, cache_dir=None,
+                force=False):
+    """
+    Build one package and return (config_path, wall time in seconds, error);
+    error is None on success.
+    """
+    start = time.monotonic()
+    error = None
+    try:
+        build_package(config_path, output_dir, num_cpus, cache_dir, force)
+    except Exception as e:  # pylint: disable=broad-except
+        error = e
+    return config_path, time.monotonic() - start, error
+
+
+def build_packages(configs, output_dir, parallel, jobs_per_build,
+                   cache_dir, force):
+    """
+    Build several packages concurrently and print a summary; return the
+    number of packages which failed to build.
+    """
+    print(f"🔧 Building {len(configs)} packages, {parallel} at a time with "
+          f"-j{jobs_per_build} each")
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        results = list(executor.map(
+            lambda config: timed_build(config, output_dir, jobs_per_build,
+                                       cache_dir, force),
+            configs))
+
+    failed = 0
+    print("📊 Build summary:")
+    for config_path, elapsed, error in results:
+        status = "✅" if error is None else "❌"
+        print(f"{status} {config_path}: {elapsed:.1f}s")
+        if error is not None:
+            print(f"    {error}")
+            failed += 1
+
+    return failed
+
+
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(
+        description="Build Debian source packages with a debdiff."
+    )
+    parser.add_argument(
+        '--config',
+        type=str,
+        nargs='+',
+        required=True,
+        help=('Path to the YAML configuration file; several files or '
+              'directories of YAML files may be given')
+    )
+    parser.add_argument(
+        '--output-dir',
+        type=str,
+        help='Optional directory to preserve resulting files'
+    )
+    parser.add_argument(
+        '--parallel',
+        type=int,
+        default=None,
+        help=('Number of packages to build concurrently; the CPUs are '
+              'split evenly between them (default: one per configuration, '
+              'up to the number of CPUs)')
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        help=('Optional directory where to cache downloaded source '
+              'packages, keyed by their SHA256 checksum')
+    )
+    parser.add_argument(
+        '--cache-max-size',
+        type=float,
+        default=20,
+        help=('Size limit of the source package cache in GiB; least '
+              'recently used entries are evicted first (default: 20)')
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help=('Rebuild even if --output-dir has the results of a build '
+              'with identical inputs')
     )
-    print("✅ Source package built successfully.")
-
-    # Copy results if output-dir is specified
-    if args.output_dir:
-        os.makedirs(args.output_dir, exist_ok=True)
-
-        # Find the .changes file
-        changes_files = glob.glob(os.path.join(temp_dir, '*.changes'))
-        if not changes_files:
-            raise RuntimeError("No .changes file found to extract artifacts.")
-        changes_file = changes_files[0]
-
-        # Run dcmd to get the list of files
-        result = subprocess.run(
-            ['dcmd', changes_file],
-            cwd=temp_dir,
-            check=True,
-            stdout=subprocess.PIPE,
-            text=True
-        )
-
-        # Parse the output to get file paths
-        files_to_copy = [
-            line.split()[-1] for line in result.stdout.strip().splitlines()]
-
-        # Add any *.build files
-        build_files = glob.glob(os.path.join(temp_dir, '*.build'))
-        files_to_copy.extend(build_files)
-
-        # Copy files
-        for file_path in files_to_copy:
-            full_path = os.path.join(temp_dir, file_path)
-            if os.path.exists(full_path):
-                shutil.copy(full_path, args.output_dir)
-
-        print(f"📦 Results copied to: {args.output_dir}")
+    parser.add_argument(
+        '--timeline',
+        type=str,
+        help=('Optional JSON file where to write the duration and resource '
+              'usage of each build phase')
+    )
+    parser.add_argument(
+        '--chrome-trace',
+        type=str,
+        help=('Optional file where to write the build phases in the Chrome '
+              'trace event format, e.g. for https://ui.perfetto.dev')
+    )
+    args = parser.parse_args()
+    # also written when the build fails
+    atexit.register(buildtrace.write, args.timeline, args.chrome_trace)
+
+    configs = find_configs(args.config)
+    if not configs:
+        sys.exit(f"No YAML configuration found in {' '.join(args.config)}")
+
+    # Determine number of CPUs for parallel build; this is a global budget
+    # shared by all the concurrent sbuild jobs
+    num_cpus = get_num_cpus()
+    parallel = args.parallel or min(len(configs), num_cpus)
+    parallel = max(1, min(parallel, len(configs)))
+    jobs_per_build = max(1, num_cpus // parallel)
+
+    failed = 0
+    try:
+        if len(configs) == 1:
+            build_package(configs[0], args.output_dir, jobs_per_build,
+                          args.cache_dir, args.force)
+        else:
+            failed = build_packages(configs, args.output_dir, parallel,
+                                    jobs_per_build, args.cache_dir,
+                                    args.force)
+    finally:
+        # keep the cache bounded even when builds fail
+        if args.cache_dir and os.path.isdir(args.cache_dir):
+            cache_evict(args.cache_dir, int(args.cache_max_size * 1024 ** 3))
+
+    if failed:
+        sys.exit(f"{failed} of {len(configs)} packages failed to build")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,23 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import argparse
+import atexit
+import bisect
+import hashlib
+import json
+import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import buildtrace
+from dpkgstatus import missing_packages
+from hashutil import file_digest
+
 # git repo/ref to use
 
 GIT_UPSTREAM = {
@@ -33,14 +46,30 @@ BASE_CONFIG = "defconfig"
 DEB_PKG_SET = "bindeb-pkg"
 
 
-def get_latest_dated_tag(repo, prefix):
+def parse_dated_tags(tags, prefix):
     """
-    Find the latest prefix-...-date tag from the repository.
-    The date is expected to be the last component of the tag.
+    Return the prefix-...-date tags among tags as a list of (date, tag)
+    tuples, sorted by date then tag; the date is expected to be the last
+    component of the tag.
     """
+    dated_tags = []
+    for tag in tags:
+        if not tag.startswith(prefix):
+            continue
+        # check for date at the end
+        date_str = tag.split("-")[-1]
+        if len(date_str) == 8 and date_str.isdigit():
+            dated_tags.append((int(date_str), tag))
+    # on the same date, the lexicographically larger tag (usually newer
+    # version) sorts last
+    dated_tags.sort()
+    return dated_tags
+
+
+def list_remote_tags(repo):
     log_i(f"Fetching tags from {repo}...")
     try:
-        result = subprocess.run(
+        result = buildtrace.run(
             ["git", "ls-remote", "--tags", "--refs", repo],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -50,41 +79,471 @@ def get_latest_dated_tag(repo, prefix):
     except subprocess.CalledProcessError as e:
         fatal(f"Failed to fetch tags from {repo}: {e.stderr}")
 
-    latest_tag = None
-    latest_date = -1
-
+    tags = []
     for line in result.stdout.splitlines():
         # output format: <hash>\trefs/tags/<tag>
         parts = line.split("\t")
         if len(parts) != 2:
             continue
         ref = parts[1]
-        if not ref.startswith("refs/tags/"):
-            continue
-        tag = ref[len("refs/tags/"):]
+        if ref.startswith("refs/tags/"):
+            tags.append(ref[len("refs/tags/"):])
+    return tags
 
-        if not tag.startswith(prefix):
-            continue
 
-        # check for date at the end
-        tag_parts = tag.split("-")
-        date_str = tag_parts[-1]
+def list_git_cache_tags(cache_dir, repo):
+    """
+    List the refs previously fetched from repo into the git cache, along
+    with the tags fetched into its tag repository.
+    """
+    remote = git_cache_remote(repo)
+    refs = set()
+    for git_dir in ("linux.git", "tags.git"):
+        result = subprocess.run(
+            ["git", "--git-dir", str(Path(cache_dir) / git_dir),
+             "for-each-ref", "--format=%(refname:lstrip=3)",
+             f"refs/cache/{remote}/"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=False,
+        )
+        refs.update(result.stdout.split())
+    return sorted(refs)
+
+
+def fetch_git_cache_tags(cache_dir, repo, prefix):
+    """
+    Fetch the prefix tags of repo into the tag repository of the git cache
+    and return them; only the tags that are new since the last fetch are
+    downloaded. The tags only carry their commits, without trees or blobs,
+    so they are kept apart from the shared object store: a partial fetch
+    would turn the remote into a promisor there, and later fetches of the
+    trees to build would be partial too.
+    """
+    git_dir = Path(cache_dir).absolute() / "tags.git"
+    remote = add_git_cache_remote(git_dir, repo)
+    log_i(f"Fetching {prefix}* tags from {repo} into git cache")
+    try:
+        buildtrace.run(
+            ["git", "--git-dir", str(git_dir), "fetch", "--quiet",
+             "--depth=1", "--filter=tree:0", "--no-tags", "--prune", remote,
+             f"+refs/tags/{prefix}*:refs/cache/{remote}/{prefix}*"],
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        fatal(f"Failed to fetch tags from {repo}: {e.stderr}")
+    result = subprocess.run(
+        ["git", "--git-dir", str(git_dir), "for-each-ref",
+         "--format=%(refname:lstrip=3)", f"refs/cache/{remote}/"],
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def get_dated_tags(repo, prefix, cache_dir=None, ttl=0, offline=False):
+    """
+    Return the sorted (date, tag) list for repo and the list of its dates,
+    for bisecting. With a cache_dir, both are kept in a tag index there and
+    only refreshed once it is older than ttl seconds, by fetching the new
+    tags into the git cache; offline, the index is used whatever its age,
+    falling back to the refs already fetched into the git cache.
+    """
+    index_file = None
+    if cache_dir:
+        index_file = (Path(cache_dir) /
+                      f"tags-{git_cache_remote(repo)}.json")
+        try:
+            with open(index_file, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if (index["repo"] == repo and index["prefix"] == prefix
+                    and (offline or time.time() - index["updated"] < ttl)):
+                log_i(f"Using tag index {index_file}")
+                return ([tuple(entry) for entry in index["tags"]],
+                        index["dates"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if offline:
+        if not cache_dir:
+            return [], []
+        log_i("Resolving tags from the git cache")
+        dated_tags = parse_dated_tags(list_git_cache_tags(cache_dir, repo),
+                                      prefix)
+        return dated_tags, [date for date, _ in dated_tags]
+
+    if cache_dir:
+        tags = fetch_git_cache_tags(cache_dir, repo, prefix)
+    else:
+        tags = list_remote_tags(repo)
+    dated_tags = parse_dated_tags(tags, prefix)
+    dates = [date for date, _ in dated_tags]
+    if index_file:
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = index_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"repo": repo, "prefix": prefix, "updated": time.time(),
+                       "tags": dated_tags, "dates": dates}, f)
+        tmp_file.replace(index_file)
+    return dated_tags, dates
+
+
+def get_latest_dated_tag(repo, prefix, before=None, cache_dir=None, ttl=0,
+                         offline=False):
+    """
+    Find the latest prefix-...-date tag from the repository, or the latest
+    one dated on or before the before date (YYYYMMDD) if set.
+    The date is expected to be the last component of the tag.
+    """
+    dated_tags, dates = get_dated_tags(repo, prefix, cache_dir, ttl, offline)
+    if before is None:
+        return dated_tags[-1][1] if dated_tags else None
+    i = bisect.bisect_right(dates, int(before))
+    return dated_tags[i - 1][1] if i else None
+
+
+def git_cache_remote(repo):
+    """
+    Name of the remote tracking repo in the git cache; the GIT_UPSTREAM key
+    for known repositories, a hash of the URL otherwise.
+    """
+    for key, upstream in GIT_UPSTREAM.items():
+        if upstream["repo"] == repo:
+            return key
+    return "repo-" + hashlib.sha256(repo.encode()).hexdigest()[:12]
+
+
+def add_git_cache_remote(git_dir, repo):
+    """
+    Create the bare repository git_dir if needed and point its remote for
+    repo at it; return the name of the remote.
+    """
+    if not git_dir.exists():
+        log_i(f"Creating git cache in {git_dir}")
+        subprocess.run(["git", "init", "--bare", "--quiet", str(git_dir)],
+                       check=True)
+
+    remote = git_cache_remote(repo)
+    remotes = subprocess.run(
+        ["git", "--git-dir", str(git_dir), "remote"],
+        stdout=subprocess.PIPE, text=True, check=True,
+    ).stdout.split()
+    if remote in remotes:
+        subprocess.run(["git", "--git-dir", str(git_dir), "remote",
+                        "set-url", remote, repo], check=True)
+    else:
+        subprocess.run(["git", "--git-dir", str(git_dir), "remote",
+                        "add", remote, repo], check=True)
+    return remote
+
+
+def update_git_cache(cache_dir, repo, ref, offline=False):
+    """
+    Fetch ref from repo into a bare repository under cache_dir and return
+    the path to the bare repository and the local ref it was fetched to.
+    All upstreams share the same object store, so only the objects that
+    aren't in the cache yet are downloaded.
+    """
+    git_dir = Path(cache_dir).absolute() / "linux.git"
+    remote = add_git_cache_remote(git_dir, repo)
+
+    local_ref = f"refs/cache/{remote}/{ref}"
+    if offline:
+        result = subprocess.run(
+            ["git", "--git-dir", str(git_dir), "rev-parse", "--verify",
+             "--quiet", local_ref],
+            stdout=subprocess.DEVNULL, check=False,
+        )
+        if result.returncode != 0:
+            fatal(f"{repo}:{ref} isn't in the git cache, can't build offline")
+        log_i(f"Using {repo}:{ref} from git cache")
+        return git_dir, local_ref
+
+    log_i(f"Fetching {repo}:{ref} into git cache")
+    buildtrace.run(
+        ["git", "--git-dir", str(git_dir), "fetch", "--depth=1",
+         "--no-tags", remote, f"+{ref}:{local_ref}"],
+        check=True,
+    )
+    return git_dir, local_ref
+
+
+def checkout_git_cache(git_dir, local_ref, linux_dir):
+    """
+    Check out local_ref from the git cache in a worktree at linux_dir; an
+    existing worktree is switched to the new ref in place, so that only the
+    files that changed are rewritten.
+    """
+    if linux_dir.exists():
+        common_dir = subprocess.run(
+            ["git", "rev-parse", "--path-format=absolute",
+             "--git-common-dir"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+            check=False, cwd=linux_dir,
+        ).stdout.strip()
+        if Path(common_dir or "/nonexistent").resolve() != git_dir.resolve():
+            fatal(f"{linux_dir} exists and isn't a worktree of {git_dir}")
+        log_i(f"Updating worktree {linux_dir} to {local_ref}")
+        buildtrace.run(
+            ["git", "checkout", "--quiet", "--force", "--detach", local_ref],
+            check=True, cwd=linux_dir,
+        )
+    else:
+        log_i(f"Creating worktree {linux_dir} for {local_ref}")
+        # forget about worktrees that were removed
+        subprocess.run(["git", "--git-dir", str(git_dir), "worktree",
+                        "prune"], check=True)
+        buildtrace.run(
+            ["git", "--git-dir", str(git_dir), "worktree", "add", "--quiet",
+             "--force", "--detach", str(linux_dir.absolute()), local_ref],
+            check=True,
+        )
+
+
+def config_cache_key(linux_dir, make_base_command, config_targets):
+    """
+    Return a key identifying the .config that the base config and config
+    fragments would produce in linux_dir, or None if the tree can't be
+    identified, i.e. it isn't a clean git checkout.
+    """
+    def git(*git_args):
+        return subprocess.run(
+            ["git", *git_args], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True, check=False, cwd=linux_dir,
+        )
+
+    tree = git("rev-parse", "HEAD^{tree}")
+    if tree.returncode != 0:
+        return None
+    # local fragments are copied to the tree as untracked files, so only
+    # look at changes to tracked files
+    if git("status", "--porcelain", "--untracked-files=no").stdout:
+        return None
+
+    # the toolchain affects the result through Kconfig's compiler checks
+    toolchain = [
+        subprocess.run([compiler, "--version"], stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL, text=True,
+                       check=False).stdout
+        for compiler in ("aarch64-linux-gnu-gcc", "gcc")
+    ]
+    inputs = {
+        "tree": tree.stdout.strip(),
+        "base_config": BASE_CONFIG,
+        # -j, O= and LOCALVERSION= don't change the resulting .config
+        "make": [arg for arg in make_base_command[1:]
+                 if not arg.startswith(("-j", "O=", "LOCALVERSION="))],
+        "fragments": [file_digest(linux_dir / target)
+                      for target in config_targets],
+        "toolchain": toolchain,
+    }
+    data = json.dumps(inputs, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def configure_linux(linux_dir, build_dir, make_base_command, config_targets,
+                    build_env, config_cache=None, output=None):
+    """
+    Generate .config from the base config and the config fragments. With a
+    config_cache directory, the result is memoized there and the kconfig
+    steps are skipped when the same tree, toolchain and fragments were
+    configured before. The output of the commands goes to the output file
+    if set.
+    """
+    kconfig = (build_dir or linux_dir) / ".config"
+
+    cached_config = None
+    if config_cache:
+        key = config_cache_key(linux_dir, make_base_command, config_targets)
+        if key is None:
+            log_i("Source tree isn't a clean git checkout, not caching "
+                  ".config")
+        else:
+            cached_config = Path(config_cache) / f"{key}.config"
+            if cached_config.exists():
+                log_i(f"Using cached configuration {cached_config}")
+                # keep .config untouched when it didn't change, so that
+                # incremental builds don't re-run kconfig
+                content = cached_config.read_bytes()
+                if not kconfig.exists() or kconfig.read_bytes() != content:
+                    kconfig.write_bytes(content)
+                return
+
+    log_i(f"Configuring Linux (base config: {BASE_CONFIG})")
+
+    # Create base defconfig first
+    buildtrace.run(make_base_command + [BASE_CONFIG], check=True,
+                   cwd=linux_dir, env=build_env, stdout=output, stderr=output)
+
+    # Merge config fragments using merge_config.sh for proper dependency
+    # handling
+    if config_targets:
+        merge_command = ["scripts/kconfig/merge_config.sh", "-m"]
+        if build_dir:
+            merge_command += ["-O", str(build_dir)]
+        merge_command += ["-r", str(kconfig.absolute())]
+        merge_command.extend(config_targets)
+        buildtrace.run(
+            merge_command,
+            check=True,
+            cwd=linux_dir,
+            env={"ARCH": "arm64", **build_env},
+            stdout=output,
+            stderr=output
+        )
+
+        # Finalize config with olddefconfig
+        buildtrace.run(
+            make_base_command + ["olddefconfig"],
+            check=True,
+            cwd=linux_dir,
+            env=build_env,
+            stdout=output,
+            stderr=output
+        )
+
+    if cached_config:
+        cached_config.parent.mkdir(parents=True, exist_ok=True)
+        # variants of a matrix build may store the same key concurrently
+        fd, tmp_config = tempfile.mkstemp(dir=cached_config.parent,
+                                          suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(kconfig, tmp_config)
+        os.replace(tmp_config, cached_config)
+
+
+def prepare_fragments(linux_dir, fragments, prefix="local"):
+    """
+    Return the config targets for fragments, relative to linux_dir; local
+    fragments are copied to the tree as kernel/configs/<prefix>_<i>.config
+    so that they can be picked up by kbuild.
+    """
+    # directory to store local config fragments so they can be picked up by
+    # kbuild
+    local_conf_dir = linux_dir / "kernel" / "configs"
+    local_conf_dir.mkdir(parents=True, exist_ok=True)
+
+    config_targets = []
+
+    for i, fragment in enumerate(fragments):
+        if Path(fragment).exists():
+            # Create a unique name for the local fragment
+            local_frag_name = f"{prefix}_{i}.config"
+            dest_path = local_conf_dir / local_frag_name
+
+            log_i(f"Copying local fragment {fragment} to {dest_path}")
+            with open(fragment, "r", encoding="utf-8") as f_in:
+                content = f_in.read()
+            with open(dest_path, "w", encoding="utf-8") as f_out:
+                f_out.write(content)
+
+            config_targets.append(f"kernel/configs/{local_frag_name}")
+        elif (linux_dir / "arch" / "arm64" / "configs" / fragment).exists():
+            log_i(f"Using config fragment from repo: {fragment}")
+            config_targets.append(f"arch/arm64/configs/{fragment}")
+        else:
+            fatal(
+                f"Config fragment '{fragment}' not found locally or in "
+                f"repository (arch/arm64/configs/)."
+            )
+    return config_targets
 
-        if len(date_str) == 8 and date_str.isdigit():
-            try:
-                date_val = int(date_str)
-                if date_val > latest_date:
-                    latest_date = date_val
-                    latest_tag = tag
-                elif date_val == latest_date:
-                    # tie-breaker: prefer lexicographically larger tag
-                    # (usually newer version)
-                    if latest_tag is None or tag > latest_tag:
-                        latest_tag = tag
-            except ValueError:
-                pass
-
-    return latest_tag
+
+def make_command(jobs, build_dir=None, ccache=False, localversion=None):
+    command = [
+        "make",
+        f"-j{jobs}",
+        "ARCH=arm64",
+        "CROSS_COMPILE=aarch64-linux-gnu-",
+        "DEB_HOST_ARCH=arm64",
+    ]
+    if build_dir:
+        command.append(f"O={build_dir}")
+    if ccache:
+        command += [
+            "CC=ccache aarch64-linux-gnu-gcc",
+            "HOSTCC=ccache gcc",
+        ]
+    if localversion:
+        command.append(f"LOCALVERSION={localversion}")
+    return command
+
+
+def parse_variant(spec):
+    """Parse a NAME=FRAGMENT[,FRAGMENT...] --variant option."""
+    name, sep, fragments = spec.partition("=")
+    if not sep or not name or "/" in name:
+        fatal(f"Invalid --variant '{spec}', use NAME=FRAGMENT[,FRAGMENT...]")
+    return name, [f for f in fragments.split(",") if f]
+
+
+def build_variant(linux_dir, variant_dir, make_base_command, config_targets,
+                  build_env, config_cache):
+    """
+    Configure and build one variant of a matrix build, out of tree in
+    variant_dir/obj; the debs end up in variant_dir and the build output in
+    variant_dir/build.log. Return (wall time in seconds, error).
+    """
+    start = time.monotonic()
+    error = None
+    with open(variant_dir / "build.log", "w", encoding="utf-8") as log:
+        try:
+            with buildtrace.phase("configure", variant=variant_dir.name):
+                configure_linux(linux_dir, variant_dir / "obj",
+                                make_base_command, config_targets, build_env,
+                                config_cache, log)
+            with buildtrace.phase("build", variant=variant_dir.name):
+                buildtrace.run(make_base_command + [DEB_PKG_SET],
+                               check=True, cwd=linux_dir, env=build_env,
+                               stdout=log, stderr=log)
+        except subprocess.CalledProcessError as e:
+            error = e
+    return time.monotonic() - start, error
+
+
+def build_matrix(linux_dir, variants, common_targets, build_root, nproc,
+                 parallel, ccache, build_env, config_cache):
+    """
+    Build several variants from the same source tree, parallel of them at
+    a time with the CPUs split between them; return the names of the
+    variants which failed to build.
+    """
+    parallel = max(1, min(parallel or len(variants), len(variants), nproc))
+    jobs = max(1, nproc // parallel)
+    log_i(f"Building {len(variants)} variants in {build_root}, {parallel} "
+          f"at a time with -j{jobs} each")
+
+    tasks = []
+    for name, fragments in variants:
+        variant_dir = build_root / name
+        (variant_dir / "obj").mkdir(parents=True, exist_ok=True)
+        targets = common_targets + prepare_fragments(
+            linux_dir, fragments, f"local_{name}")
+        command = make_command(jobs, variant_dir / "obj", ccache, f"-{name}")
+        tasks.append((name, variant_dir, command, targets))
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [
+            executor.submit(build_variant, linux_dir, variant_dir, command,
+                            targets, build_env, config_cache)
+            for _, variant_dir, command, targets in tasks
+        ]
+        results = [future.result() for future in futures]
+
+    failed = []
+    for (name, variant_dir, _, _), (elapsed, error) in zip(tasks, results):
+        if error is None:
+            log_i(f"Variant {name} built in {elapsed:.0f}s, debs in "
+                  f"{variant_dir}")
+        else:
+            log_i(f"Variant {name} failed after {elapsed:.0f}s, see "
+                  f"{variant_dir / 'build.log'}")
+            failed.append(name)
+    return failed
 
 
 def log_i(msg):
@@ -96,27 +555,7 @@ def fatal(msg):
     sys.exit(1)
 
 
-def check_package_installed(pkg):
-    """Check if a package is installed using dpkg."""
-    try:
-        # dpkg -l "${pkg}" 2>&1 | grep -q "^ii  ${pkg}"
-        result = subprocess.run(
-            ["dpkg", "-l", pkg],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            check=False,
-        )
-        for line in result.stdout.splitlines():
-            # Match exactly "ii  <pkg>" at start of line
-            if line.startswith(f"ii  {pkg}"):
-                return True
-    except subprocess.SubprocessError:
-        pass
-    return False
-
-
-def check_dependencies():
+def check_dependencies(extra_packages=()):
     packages = [
         # needed to clone repository
         "git",
@@ -141,15 +580,11 @@ def check_dependencies():
         # for nproc
         "coreutils",
     ]
+    packages.extend(extra_packages)
 
     log_i(f"Checking build-dependencies ({' '.join(packages)})")
 
-    missing = []
-    for pkg in packages:
-        if check_package_installed(pkg):
-            continue
-        missing.append(pkg)
-
+    missing = missing_packages(packages)
     if missing:
         fatal(f"Missing build-dependencies: {' '.join(missing)}")
 
@@ -186,6 +621,96 @@ def main():
         help=("Path to an existing Linux kernel source tree;"
               " if not set, the repo will be cloned into ./linux"),
     )
+    parser.add_argument(
+        "--git-cache",
+        type=str,
+        default=None,
+        help=("Path to a persistent git cache; when set, the repo is"
+              " fetched incrementally into a bare repository there and"
+              " ./linux is a worktree of it instead of a fresh clone"),
+    )
+    parser.add_argument(
+        "--tag-cache-ttl",
+        type=int,
+        default=3600,
+        help=("With --git-cache, how long in seconds the index of dated tags"
+              " is reused before fetching the new remote tags"
+              " (default: 3600)"),
+    )
+    parser.add_argument(
+        "--before-date",
+        type=str,
+        default=None,
+        help=("Use the latest dated tag on or before this date (YYYYMMDD)"
+              " rather than the latest one, e.g. to reproduce a build"),
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help=("With --git-cache, don't access the network; tags and refs"
+              " are resolved from the cache"),
+    )
+    parser.add_argument(
+        "--config-cache",
+        type=str,
+        default=None,
+        help=("Directory where to cache the generated .config, keyed by"
+              " source tree, toolchain and config fragments; the kernel"
+              " configuration steps are skipped on a hit"),
+    )
+    parser.add_argument(
+        "--ccache-dir",
+        type=str,
+        default=None,
+        help=("Compile through ccache, with its cache in this directory;"
+              " cache statistics are printed after the build"),
+    )
+    parser.add_argument(
+        "--ccache-max-size",
+        type=str,
+        default="20G",
+        help="Size limit of the ccache cache (default: 20G)",
+    )
+    parser.add_argument(
+        "--build-dir",
+        type=str,
+        default=None,
+        help=("Build out of tree in this directory (make O=); keeping it"
+              " between runs only recompiles what changed. The debs are"
+              " written to its parent directory. With --variant, the root"
+              " of the variant build directories (default: build-matrix)"),
+    )
+    parser.add_argument(
+        "--variant",
+        action="append",
+        default=[],
+        metavar="NAME=FRAGMENT[,FRAGMENT...]",
+        help=("Build a variant with these config fragments on top of the"
+              " common ones; may be repeated to build a matrix of kernels"
+              " from the same source tree, each out of tree in"
+              " <build-dir>/NAME/obj with its debs in <build-dir>/NAME"),
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=None,
+        help=("With --variant, number of variants to build concurrently;"
+              " the CPUs are split evenly between them (default: all)"),
+    )
+    parser.add_argument(
+        "--timeline",
+        type=str,
+        default=None,
+        help=("JSON file where to write the wall time, CPU time, peak RSS"
+              " and I/O of each build phase"),
+    )
+    parser.add_argument(
+        "--chrome-trace",
+        type=str,
+        default=None,
+        help=("File where to write the build phases in the Chrome trace"
+              " event format, e.g. for https://ui.perfetto.dev"),
+    )
 
     parser.add_argument(
         "fragments",
@@ -199,6 +724,9 @@ def main():
     args, unknown = parser.parse_known_args()
     # Combine positional fragments with unknown args (fragments after flags)
     args.fragments = args.fragments + unknown
+    variants = [parse_variant(spec) for spec in args.variant]
+    # also written when the build fails
+    atexit.register(buildtrace.write, args.timeline, args.chrome_trace)
 
     # default settings for next trees
     git_upstream_key = None
@@ -215,104 +743,103 @@ def main():
             args.ref = GIT_UPSTREAM[git_upstream_key]["ref"]
             ref_prefix = GIT_UPSTREAM[git_upstream_key]["ref_prefix"]
 
-    if ref_prefix:
-        found_tag = get_latest_dated_tag(args.repo, ref_prefix)
-        if found_tag:
-            log_i(f"Found latest tag: {found_tag}")
-            args.ref = found_tag
-        else:
-            log_i("No suitable tag found, falling back to default ref")
-
-    check_dependencies()
-
-    if args.local_dir:
-        linux_dir = Path(args.local_dir)
-        if not linux_dir.exists():
-            fatal(f"Provided --local-dir '{linux_dir}' does not exist")
-        log_i(f"Using existing kernel source at {linux_dir}")
-    else:
-        linux_dir = Path("linux")
-        log_i(f"Cloning Linux ({args.repo}:{args.ref}) into {linux_dir}")
-        subprocess.run(
-            [
-                "git",
-                "clone",
-                "--depth=1",
-                "--branch",
-                args.ref,
-                args.repo,
-                str(linux_dir),
-            ],
-            check=True,
-        )
-
-    log_i(f"Configuring Linux (base config: {BASE_CONFIG})")
-    # directory to store local config fragments so they can be picked up by
-    # kbuild
-    local_conf_dir = linux_dir / "kernel" / "configs"
-    local_conf_dir.mkdir(parents=True, exist_ok=True)
-
-    config_targets = []
-
-    for i, fragment in enumerate(args.fragments):
-        if Path(fragment).exists():
-            # Create a unique name for the local fragment
-            local_frag_name = f"local_{i}.config"
-            dest_path = local_conf_dir / local_frag_name
-
-            log_i(f"Copying local fragment {fragment} to {dest_path}")
-            with open(fragment, "r", encoding="utf-8") as f_in:
-                content = f_in.read()
-            with open(dest_path, "w", encoding="utf-8") as f_out:
-                f_out.write(content)
+    if args.before_date and not (len(args.before_date) == 8
+                                 and args.before_date.isdigit()):
+        fatal(f"Invalid --before-date '{args.before_date}', use YYYYMMDD")
+    if args.offline and not (args.git_cache or args.local_dir):
+        fatal("--offline requires --git-cache or --local-dir")
 
-            config_targets.append(f"kernel/configs/{local_frag_name}")
-        elif (linux_dir / "arch" / "arm64" / "configs" / fragment).exists():
-            log_i(f"Using config fragment from repo: {fragment}")
-            config_targets.append(f"arch/arm64/configs/{fragment}")
+    if ref_prefix:
+        with buildtrace.phase("tags"):
+            found_tag = get_latest_dated_tag(
+                args.repo, ref_prefix, args.before_date, args.git_cache,
+                args.tag_cache_ttl, args.offline)
+            if found_tag:
+                log_i(f"Found latest tag: {found_tag}")
+                args.ref = found_tag
+            else:
+                log_i("No suitable tag found, falling back to default ref")
+
+    with buildtrace.phase("dependencies"):
+        check_dependencies(["ccache"] if args.ccache_dir else [])
+
+    with buildtrace.phase("fetch"):
+        if args.local_dir:
+            linux_dir = Path(args.local_dir)
+            if not linux_dir.exists():
+                fatal(f"Provided --local-dir '{linux_dir}' does not exist")
+            log_i(f"Using existing kernel source at {linux_dir}")
+        elif args.git_cache:
+            linux_dir = Path("linux")
+            git_dir, local_ref = update_git_cache(args.git_cache, args.repo,
+                                                  args.ref, args.offline)
+            checkout_git_cache(git_dir, local_ref, linux_dir)
         else:
-            fatal(
-                f"Config fragment '{fragment}' not found locally or in "
-                f"repository (arch/arm64/configs/)."
+            linux_dir = Path("linux")
+            log_i(f"Cloning Linux ({args.repo}:{args.ref}) into {linux_dir}")
+            buildtrace.run(
+                [
+                    "git",
+                    "clone",
+                    "--depth=1",
+                    "--branch",
+                    args.ref,
+                    args.repo,
+                    str(linux_dir),
+                ],
+                check=True,
             )
 
-    nproc = subprocess.check_output(["nproc"], text=True).strip()
-    make_base_command = [
-        "make",
-        f"-j{nproc}",
-        "ARCH=arm64",
-        "CROSS_COMPILE=aarch64-linux-gnu-",
-        "DEB_HOST_ARCH=arm64",
-    ]
-
-    # Create base defconfig first
-    subprocess.run(make_base_command + [BASE_CONFIG], check=True,
-                   cwd=linux_dir)
-
-    # Merge config fragments using merge_config.sh for proper dependency
-    # handling
-    if config_targets:
-        merge_command = [
-            "scripts/kconfig/merge_config.sh", "-m", "-r", ".config"
-        ]
-        merge_command.extend(config_targets)
-        subprocess.run(
-            merge_command,
-            check=True,
-            cwd="linux",
-            env={"ARCH": "arm64", **subprocess.os.environ}
-        )
-
-        # Finalize config with olddefconfig
-        subprocess.run(
-            make_base_command + ["olddefconfig"],
-            check=True,
-            cwd="linux"
-        )
-
-    log_i("Building Linux deb")
-    build_command = make_base_command + [DEB_PKG_SET]
-    subprocess.run(build_command, check=True, cwd=linux_dir)
+    config_targets = prepare_fragments(linux_dir, args.fragments)
+    nproc = int(subprocess.check_output(["nproc"], text=True).strip())
+
+    build_env = os.environ.copy()
+    if args.ccache_dir:
+        ccache_dir = Path(args.ccache_dir).absolute()
+        ccache_dir.mkdir(parents=True, exist_ok=True)
+        build_env["CCACHE_DIR"] = str(ccache_dir)
+        # hash paths relative to the directory holding the source and build
+        # trees, so that moving them around doesn't invalidate the cache
+        build_env["CCACHE_BASEDIR"] = str(linux_dir.absolute().parent)
+        subprocess.run(["ccache", "--max-size", args.ccache_max_size],
+                       check=True, env=build_env, stdout=subprocess.DEVNULL)
+        subprocess.run(["ccache", "--zero-stats"], check=True, env=build_env,
+                       stdout=subprocess.DEVNULL)
+
+    failed = []
+    if variants:
+        build_root = Path(args.build_dir or "build-matrix").absolute()
+        failed = build_matrix(linux_dir, variants, config_targets,
+                              build_root, nproc, args.parallel,
+                              bool(args.ccache_dir), build_env,
+                              args.config_cache)
+    else:
+        # .config lives in the output directory
+        build_dir = None
+        if args.build_dir:
+            build_dir = Path(args.build_dir).absolute()
+            build_dir.mkdir(parents=True, exist_ok=True)
+            log_i(f"Building out of tree in {build_dir}")
+        make_base_command = make_command(nproc, build_dir,
+                                         bool(args.ccache_dir))
+
+        with buildtrace.phase("configure"):
+            configure_linux(linux_dir, build_dir, make_base_command,
+                            config_targets, build_env, args.config_cache)
+
+        log_i("Building Linux deb")
+        build_command = make_base_command + [DEB_PKG_SET]
+        with buildtrace.phase("build"):
+            buildtrace.run(build_command, check=True, cwd=linux_dir,
+                           env=build_env)
+
+    if args.ccache_dir:
+        log_i("ccache statistics for this build:")
+        subprocess.run(["ccache", "--show-stats"], check=True, env=build_env,
+                       stdout=sys.stderr)
+
+    if failed:
+        fatal(f"Failed to build variants: {' '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Per-phase instrumentation for the build scripts in this directory; the
+# wall time of each phase is recorded along with the CPU time, peak RSS and
+# block I/O of the commands run in it through run(). The timeline can be
+# written as JSON, or in the Chrome trace event format to be browsed with
+# chrome://tracing or https://ui.perfetto.dev
+#
+# Phases nest and are tracked per thread: a command counts towards all the
+# phases open in the thread which runs it.
+
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# resource usage is reported in 512 bytes blocks for block I/O
+BLOCK_SIZE = 512
+
+_lock = threading.Lock()
+_events = []
+_local = threading.local()
+_start = time.perf_counter()
+_start_time = time.time()
+
+
+class _Usage:
+    __slots__ = ('user_cpu', 'sys_cpu', 'max_rss_kib', 'read_bytes',
+                 'write_bytes', 'commands')
+
+    def __init__(self):
+        self.user_cpu = 0.0
+        self.sys_cpu = 0.0
+        self.max_rss_kib = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.commands = 0
+
+    def add(self, rusage):
+        self.user_cpu += rusage.ru_utime
+        self.sys_cpu += rusage.ru_stime
+        # ru_maxrss is in KiB on Linux
+        self.max_rss_kib = max(self.max_rss_kib, rusage.ru_maxrss)
+        self.read_bytes += rusage.ru_inblock * BLOCK_SIZE
+        self.write_bytes += rusage.ru_oublock * BLOCK_SIZE
+        self.commands += 1
+
+    def as_dict(self):
+        return {name: round(getattr(self, name), 6)
+                for name in self.__slots__}
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _record(name, category, start, end, usage, args):
+    event = {
+        'name': name,
+        'category': category,
+        'thread': threading.current_thread().name,
+        'start': round(start - _start, 6),
+        'wall': round(end - start, 6),
+        **usage.as_dict(),
+    }
+    if args:
+        event['args'] = args
+    with _lock:
+        _events.append(event)
+
+
+@contextmanager
+def phase(name, **args):
+    """
+    Record the phase name for the duration of the with block; args are
+    stored with it, e.g. to tell apart the phases of concurrent builds.
+    """
+    usage = _Usage()
+    stack = _stack()
+    stack.append(usage)
+    start = time.perf_counter()
+    thread_cpu = time.thread_time()
+    try:
+        yield
+    except BaseException:
+        args['failed'] = True
+        raise
+    finally:
+        stack.pop()
+        # CPU time spent in this process, e.g. hashing files
+        args['python_cpu'] = round(time.thread_time() - thread_cpu, 6)
+        _record(name, 'phase', start, time.perf_counter(), usage, args)
+
+
+def _read_output(proc):
+    output = {}
+
+    def read(name, stream):
+        with stream:
+            output[name] = stream.read()
+
+    # read stdout and stderr concurrently so that neither pipe fills up
+    threads = [
+        threading.Thread(target=read, args=(name, getattr(proc, name)))
+        for name in ('stdout', 'stderr') if getattr(proc, name) is not None
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return output.get('stdout'), output.get('stderr')
+
+
+def run(args, check=False, **kwargs):
+    """
+    Drop-in replacement for subprocess.run() (without input and timeout)
+    recording the resource usage of the command, and of the processes it
+    waited for, in the current phases.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(args, **kwargs)
+    try:
+        stdout, stderr = _read_output(proc)
+        # unlike Popen.wait(), wait4() returns the resource usage of the
+        # command alone, even with other commands running concurrently
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    end = time.perf_counter()
+
+    usage = _Usage()
+    usage.add(rusage)
+    for phase_usage in _stack():
+        phase_usage.add(rusage)
+    if isinstance(args, (str, bytes, os.PathLike)):
+        argv = [os.fspath(args)]
+    else:
+        argv = [os.fspath(arg) for arg in args]
+    _record(os.path.basename(argv[0]), 'command', start, end, usage,
+            {'argv': argv, 'returncode': proc.returncode})
+
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args, stdout,
+                                            stderr)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+def events():
+    """Return a copy of the events recorded so far, by start time."""
+    with _lock:
+        return sorted(_events, key=lambda event: event['start'])
+
+
+def write_timeline(path):
+    """Write the recorded events to path as JSON."""
+    timeline = {
+        'start_time': _start_time,
+        'pid': os.getpid(),
+        'events': events(),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(timeline, f, indent=2)
+
+
+def write_chrome_trace(path):
+    """Write the recorded events to path in the Chrome trace event format."""
+    pid = os.getpid()
+    tids = {}
+    trace_events = []
+    for event in events():
+        tid = tids.setdefault(event['thread'], len(tids))
+        args = {key: value for key, value in event.items()
+                if key not in ('name', 'category', 'thread', 'start', 'wall',
+                               'args')}
+        args.update(event.get('args', {}))
+        trace_events.append({
+            'name': event['name'],
+            'cat': event['category'],
+            'ph': 'X',
+            'ts': round(event['start'] * 1e6),
+            'dur': round(event['wall'] * 1e6),
+            'pid': pid,
+            'tid': tid,
+            'args': args,
+        })
+    for thread, tid in tids.items():
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                             'tid': tid, 'args': {'name': thread}})
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': trace_events,
+                   'displayTimeUnit': 'ms'}, f)
+
+
+def write(timeline=None, chrome_trace=None):
+    """Write the timeline and/or the Chrome trace, if a path is set."""
+    if timeline:
+        write_timeline(timeline)
+    if chrome_trace:
+        write_chrome_trace(chrome_trace)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Bundle the flash_* directories of the current directory into one tarball
+# for all eMMC boards and one for all UFS boards, along with the disk images
+# and per-SoC multi-DTB FIT images they reference:
+#   <output_dir>/<prefix>-flash-emmc.tar.gz
+#   <output_dir>/<prefix>-flash-ufs.tar.gz
+#
+# The storage of each flash directory is inferred from the rootfs image in
+# its rawprogram0.xml. Both tarballs are written concurrently and compressed
+# with pigz, sharing the CPUs between them, or with gzip if pigz isn't
+# installed. Files with the same contents are only stored once in each
+# tarball, later copies are stored as hardlinks to the first one; as these
+# hardlinks may cross flash_* directories, a single flash_* directory can't
+# be extracted from a tarball on its own, the whole tarball is needed.
+#
+# Usage:  bundle-flash-dirs.py <output_dir> <prefix>
+
+import argparse
+import glob
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hashutil import digest_files
+from rawprogram import program_filenames
+
+# disk images referenced by the flash directories of each storage
+DISK_IMAGES = {
+    "emmc": ["disk-sdcard.img1", "disk-sdcard.img2"],
+    "ufs": ["disk-ufs.img1", "disk-ufs.img2"],
+}
+# size of the reads from the files added to the tarballs
+COPY_BUFSIZE = 1024 * 1024
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message, flush=True)
+
+
+def flash_dir_storage(flash_dir):
+    """Return the storage of flash_dir, from its rootfs image"""
+    rawprogram0 = os.path.join(flash_dir, "rawprogram0.xml")
+    print(f"examining {rawprogram0}")
+    rootfs_img = program_filenames(rawprogram0).get("rootfs", "none")
+    if "disk-sdcard" in rootfs_img:
+        print("choosing emmc")
+        return "emmc"
+    if "disk-ufs" in rootfs_img:
+        print("choosing ufs")
+        return "ufs"
+    print("couldn't find disk-ufs or disk-emmc, choosing emmc by default")
+    return "emmc"
+
+
+def walk(paths):
+    """
+    Yield the paths in the tarball for paths and their contents, like tar,
+    directories first then their entries sorted by name
+    """
+    for path in paths:
+        yield path
+        if os.path.isdir(path) and not os.path.islink(path):
+            yield from walk(os.path.join(path, name)
+                            for name in sorted(os.listdir(path)))
+
+
+def duplicate_digests(members):
+    """
+    Return the digests by (st_dev, st_ino) of the regular files of members
+    (lists of the paths in each tarball) which might have the same contents
+    as another file of the same tarball, i.e. with the same size; other
+    files are unique and don't need hashing. Digests are keyed by inode as
+    only one of the paths of each inode is hashed.
+    """
+    candidates = {}
+    for paths in members:
+        by_size = {}
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                sys.exit(f"Can't bundle flash directories, {path} is missing")
+            if stat.S_ISREG(st.st_mode):
+                by_size.setdefault(st.st_size, {})[
+                    (st.st_dev, st.st_ino)] = path
+        for inodes in by_size.values():
+            # hardlinks to the same inode are identical already
+            if len(inodes) > 1:
+                candidates.update(inodes)
+    digests = digest_files(candidates.values())
+    return {inode: digests[path] for inode, path in candidates.items()}
+
+
+def compressor_command(jobs):
+    if shutil.which("pigz"):
+        return ["pigz", "-c", "-p", str(jobs)]
+    return ["gzip", "-c"]
+
+
+def write_bundle(name, output, paths, digests, jobs):
+    """
+    Write the tarball output with paths, storing files with the same
+    contents as hardlinks; return the number of bytes stored as hardlinks
+    """
+    start = time.monotonic()
+    saved = 0
+    total = 0
+    with open(output, "wb") as f:
+        proc = subprocess.Popen(compressor_command(jobs),
+                                stdin=subprocess.PIPE, stdout=f)
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|",
+                              format=tarfile.GNU_FORMAT,
+                              bufsize=COPY_BUFSIZE) as tar:
+                tar.copybufsize = COPY_BUFSIZE
+                # first path stored by digest
+                stored = {}
+                for path in paths:
+                    info = tar.gettarinfo(path)
+                    st = os.lstat(path)
+                    size = st.st_size
+                    digest = digests.get((st.st_dev, st.st_ino))
+                    if info.isreg() and digest:
+                        first = stored.setdefault((size, digest), info.name)
+                        if first != info.name:
+                            info.type = tarfile.LNKTYPE
+                            info.linkname = first
+                            info.size = 0
+                    if info.islnk():
+                        # identical contents, or a hardlink to the same inode
+                        saved += size
+                        total += size
+                        log(f"{name}: {info.name} link to {info.linkname}")
+                        tar.addfile(info)
+                    elif info.isreg():
+                        total += size
+                        log(f"{name}: {info.name}")
+                        with open(path, "rb") as fileobj:
+                            tar.addfile(info, fileobj)
+                    else:
+                        log(f"{name}: {info.name}")
+                        tar.addfile(info)
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, proc.args)
+    log(f"{name}: wrote {output} in {time.monotonic() - start:.1f}s, "
+        f"{os.path.getsize(output)} bytes from {total} bytes of files, "
+        f"{saved} bytes stored as hardlinks")
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bundle the flash directories of all eMMC and all UFS "
+                    "boards into tarballs")
+    parser.add_argument("output_dir", help="directory to write tarballs to")
+    parser.add_argument("prefix", help="prefix of the tarball filenames")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    dirs = {storage: [] for storage in DISK_IMAGES}
+    for flash_dir in sorted(glob.glob("flash_*")):
+        storage = flash_dir_storage(flash_dir)
+        print(f"choosen target {storage} for {flash_dir}")
+        dirs[storage].append(flash_dir)
+    for storage, flash_dirs in dirs.items():
+        print(f"{storage}_dirs: {' '.join(flash_dirs)}")
+
+    # per-SoC multi-DTB FIT images shared across boards; all of them land
+    # in each bundle (there may be none for a given build)
+    multidtb_bins = sorted(glob.glob("dtb-multidtb-*.bin"))
+    print(f"multidtb_bins: {' '.join(multidtb_bins)}")
+
+    bundles = {
+        storage: list(walk(DISK_IMAGES[storage] + multidtb_bins + flash_dirs))
+        for storage, flash_dirs in dirs.items()
+    }
+    digests = duplicate_digests(bundles.values())
+
+    # share the CPUs between the compressors
+    jobs = max(1, (os.cpu_count() or 1) // len(bundles))
+    with ThreadPoolExecutor(max_workers=len(bundles)) as executor:
+        futures = [
+            executor.submit(
+                write_bundle, storage,
+                os.path.join(args.output_dir,
+                             f"{args.prefix}-flash-{storage}.tar.gz"),
+                paths, digests, jobs)
+            for storage, paths in bundles.items()
+        ]
+        try:
+            saved = sum(future.result() for future in futures)
+        except (OSError, subprocess.CalledProcessError) as e:
+            sys.exit(f"Failed to write flash bundles: {e}")
+
+    print(f"Bundled flash directories in {time.monotonic() - start:.1f}s, "
+          f"{saved} bytes saved by storing identical files as hardlinks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Lookup of installed Debian packages, shared by the scripts in this
+# directory; the dpkg status database is read once into an index, rather
+# than running dpkg for each package to check
+
+import functools
+
+DPKG_STATUS = "/var/lib/dpkg/status"
+
+
+@functools.lru_cache(maxsize=None)
+def installed_packages(status_file=DPKG_STATUS):
+    """
+    Return a dict mapping the name of each installed package to the set of
+    its installed architectures.
+    """
+    try:
+        with open(status_file, "r", encoding="utf-8", errors="replace") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return {}
+
+    installed = {}
+    for paragraph in content.split("\n\n"):
+        name = arch = status = None
+        for line in paragraph.splitlines():
+            if line.startswith("Package: "):
+                name = line[len("Package: "):].strip()
+            elif line.startswith("Architecture: "):
+                arch = line[len("Architecture: "):].strip()
+            elif line.startswith("Status: "):
+                status = line[len("Status: "):].split()
+        # same as the "ii" state of dpkg -l
+        if name and status and status[0] == "install" and \
+                status[-1] == "installed":
+            installed.setdefault(name, set()).add(arch)
+    return installed
+
+
+def is_installed(package, status_file=DPKG_STATUS):
+    """
+    Check whether package is installed; package may be qualified with an
+    architecture, e.g. libssl-dev:arm64.
+    """
+    name, _, arch = package.partition(":")
+    archs = installed_packages(status_file).get(name)
+    if not archs:
+        return False
+    return not arch or arch in archs or "all" in archs
+
+
+def missing_packages(packages, status_file=DPKG_STATUS):
+    """Return the packages which aren't installed, in the same order."""
+    return [pkg for pkg in packages if not is_installed(pkg, status_file)]
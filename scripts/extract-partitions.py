@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Extract the partitions of a GPT disk image to one file each, named after
+# the image and the partition number like fdisk device names, e.g.
+# disk-ufs.img1, disk-ufs.img2...
+#
+# The GPT is read directly from the image; the backup GPT at the end of the
+# image is used if the primary one is corrupted. Only the data extents of
+# the image (as found with SEEK_DATA/SEEK_HOLE) are copied, with
+# copy_file_range(), which shares the data with the image on filesystems
+# supporting reflinks; holes are left as holes so that the partition images
+# stay sparse. Partitions are extracted concurrently.
+#
+# With --android-sparse, partitions are written in the Android sparse image
+# format instead, e.g. to be flashed by qdl from rawprogram entries with
+# sparse="true"; holes are skipped and zero blocks written as fill chunks.
+#
+# Usage:  extract-partitions.py [--sector-size 512|4096] [--output-dir DIR]
+#             [--android-sparse] <disk image>
+#
+# Example:
+#   $ python3 extract-partitions.py --sector-size 4096 --output-dir out \
+#         disk-ufs.img
+#   disk-ufs.img1: 536870912 bytes (esp), 1048576 bytes of data
+#   ...
+
+import argparse
+import errno
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+GPT_SIGNATURE = b"EFI PART"
+# signature, revision, header size, header CRC32, reserved, current LBA,
+# backup LBA, first usable LBA, last usable LBA, disk GUID, partition
+# entries LBA, number of entries, entry size, entries CRC32
+GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+# type GUID, partition GUID, first LBA, last LBA, attributes, name
+GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+UNUSED_TYPE = bytes(16)
+
+SPARSE_MAGIC = 0xED26FF3A
+# magic, major and minor version, file header size, chunk header size,
+# block size, total blocks, total chunks, image checksum
+SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+# chunk type, reserved, size in blocks, total size in bytes with header
+SPARSE_CHUNK = struct.Struct("<HHII")
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+SPARSE_BLOCK_SIZE = 4096
+
+# size of each copy_file_range() call or read
+COPY_SIZE = 16 * 1024 * 1024
+
+
+class Partition:
+    __slots__ = ("number", "name", "first_lba", "last_lba")
+
+    def __init__(self, number, name, first_lba, last_lba):
+        self.number = number
+        self.name = name
+        self.first_lba = first_lba
+        self.last_lba = last_lba
+
+
+def read_gpt_header(f, lba, sector_size):
+    """Return the fields of the GPT header at lba if valid, else None"""
+    f.seek(lba * sector_size)
+    data = f.read(sector_size)
+    if len(data) < GPT_HEADER.size or not data.startswith(GPT_SIGNATURE):
+        return None
+    header = GPT_HEADER.unpack_from(data)
+    header_size, header_crc = header[2], header[3]
+    if not GPT_HEADER.size <= header_size <= sector_size:
+        return None
+    # the CRC is computed with the CRC field zeroed
+    raw = bytearray(data[:header_size])
+    raw[16:20] = bytes(4)
+    if zlib.crc32(raw) != header_crc:
+        return None
+    return header
+
+
+def detect_sector_size(f):
+    """Return the sector size with which a GPT header is found in f"""
+    image_size = os.fstat(f.fileno()).st_size
+    for sector_size in (512, 4096):
+        # primary or backup GPT header
+        for lba in (1, image_size // sector_size - 1):
+            if read_gpt_header(f, lba, sector_size):
+                return sector_size
+    return 512
+
+
+def read_partitions(f, sector_size):
+    """Return the partitions of the GPT disk image open in f"""
+    image_size = os.fstat(f.fileno()).st_size
+    header = read_gpt_header(f, 1, sector_size)
+    entries = None
+    if header:
+        entries = read_gpt_entries(f, header, sector_size)
+    if entries is None:
+        # corrupted primary GPT; try the backup GPT in the last sector
+        print("Primary GPT is invalid, using the backup GPT",
+              file=sys.stderr)
+        header = read_gpt_header(f, image_size // sector_size - 1,
+                                 sector_size)
+        if header:
+            entries = read_gpt_entries(f, header, sector_size)
+    if entries is None:
+        sys.exit(f"No valid GPT found with {sector_size} bytes sectors")
+
+    partitions = []
+    for i, entry in enumerate(entries):
+        type_guid, _, first_lba, last_lba, _, name = entry
+        if type_guid == UNUSED_TYPE:
+            continue
+        if last_lba < first_lba or \
+                (last_lba + 1) * sector_size > image_size:
+            sys.exit(f"Partition {i + 1} is outside of the image")
+        partitions.append(Partition(
+            i + 1,
+            name.decode("utf-16-le").split("\0", 1)[0],
+            first_lba,
+            last_lba,
+        ))
+    return partitions
+
+
+def read_gpt_entries(f, header, sector_size):
+    """Return the partition entries of header if their CRC is valid"""
+    entries_lba, num_entries, entry_size, entries_crc = header[10:14]
+    if entry_size < GPT_ENTRY.size:
+        return None
+    f.seek(entries_lba * sector_size)
+    data = f.read(num_entries * entry_size)
+    if len(data) != num_entries * entry_size or \
+            zlib.crc32(data) != entries_crc:
+        return None
+    return [GPT_ENTRY.unpack_from(data, i * entry_size)
+            for i in range(num_entries)]
+
+
+def data_extents(fd, start, end):
+    """
+    Yield the (start, end) offsets of the data in the range [start, end)
+    of fd, skipping holes
+    """
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no data after offset
+                return
+            # SEEK_DATA not supported; everything is data
+            yield offset, end
+            return
+        if data >= end:
+            return
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        yield data, hole
+        offset = hole
+
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    """Copy length bytes between offsets, sharing data where supported"""
+    while length:
+        count = min(length, COPY_SIZE)
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, count, src_offset,
+                                        dst_offset)
+        except (AttributeError, OSError):
+            # no copy_file_range(), e.g. across filesystems on older kernels
+            data = os.pread(src_fd, count, src_offset)
+            copied = os.pwrite(dst_fd, data, dst_offset)
+        if not copied:
+            raise OSError(errno.EIO, "Unexpected end of image")
+        src_offset += copied
+        dst_offset += copied
+        length -= copied
+
+
+def extract_raw(src_fd, start, length, output):
+    """Extract a sparse raw copy; return the number of bytes of data"""
+    data_bytes = 0
+    dst_fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # holes are left unallocated
+        os.ftruncate(dst_fd, length)
+        for data_start, data_end in data_extents(src_fd, start,
+                                                 start + length):
+            copy_range(src_fd, dst_fd, data_start, data_start - start,
+                       data_end - data_start)
+            data_bytes += data_end - data_start
+    finally:
+        os.close(dst_fd)
+    return data_bytes
+
+
+def sparse_chunks(src_fd, start, length, block_size):
+    """
+    Yield the (chunk type, blocks, data) chunks of the Android sparse image
+    of the range [start, start + length) of src_fd
+    """
+    zero_block = bytes(block_size)
+    blocks = length // block_size
+    block = 0
+    for data_start, data_end in data_extents(src_fd, start, start + length):
+        # round outwards to whole blocks
+        first = (data_start - start) // block_size
+        last = -(-(data_end - start) // block_size)
+        first = max(first, block)
+        if first >= last:
+            continue
+        if first > block:
+            yield CHUNK_TYPE_DONT_CARE, first - block, None
+        raw = []
+        zeros = 0
+        for offset in range(first, last, COPY_SIZE // block_size):
+            count = min(COPY_SIZE // block_size, last - offset)
+            data = memoryview(os.pread(src_fd, count * block_size,
+                                       start + offset * block_size))
+            for i in range(count):
+                chunk = data[i * block_size:(i + 1) * block_size]
+                if chunk == zero_block:
+                    if raw:
+                        yield CHUNK_TYPE_RAW, len(raw), b"".join(raw)
+                        raw = []
+                    zeros += 1
+                else:
+                    if zeros:
+                        yield CHUNK_TYPE_FILL, zeros, bytes(4)
+                        zeros = 0
+                    raw.append(chunk)
+                    if len(raw) * block_size >= COPY_SIZE:
+                        yield CHUNK_TYPE_RAW, len(raw), b"".join(raw)
+                        raw = []
+        if raw:
+            yield CHUNK_TYPE_RAW, len(raw), b"".join(raw)
+        if zeros:
+            yield CHUNK_TYPE_FILL, zeros, bytes(4)
+        block = last
+    if block < blocks:
+        yield CHUNK_TYPE_DONT_CARE, blocks - block, None
+
+
+def extract_android_sparse(src_fd, start, length, output, sector_size):
+    """Extract an Android sparse image; return the number of bytes of data"""
+    # the sparse block size has to divide the partition size
+    block_size = SPARSE_BLOCK_SIZE
+    if length % block_size:
+        block_size = sector_size
+    data_bytes = 0
+    chunks = 0
+    with open(output, "wb") as f:
+        # the header is rewritten with the chunk count once done
+        f.write(bytes(SPARSE_HEADER.size))
+        for chunk_type, blocks, data in sparse_chunks(src_fd, start, length,
+                                                      block_size):
+            data = data or b""
+            f.write(SPARSE_CHUNK.pack(chunk_type, 0, blocks,
+                                      SPARSE_CHUNK.size + len(data)))
+            f.write(data)
+            if chunk_type == CHUNK_TYPE_RAW:
+                data_bytes += len(data)
+            chunks += 1
+        f.seek(0)
+        f.write(SPARSE_HEADER.pack(SPARSE_MAGIC, 1, 0, SPARSE_HEADER.size,
+                                   SPARSE_CHUNK.size, block_size,
+                                   length // block_size, chunks, 0))
+    return data_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract the partitions of a GPT disk image")
+    parser.add_argument("--sector-size", type=int, choices=[512, 4096],
+                        help="logical sector size of the image (default: "
+                             "detected from the GPT header location)")
+    parser.add_argument("--output-dir", default=".",
+                        help="directory to write the partition images to "
+                             "(default: current directory)")
+    parser.add_argument("--android-sparse", action="store_true",
+                        help="write Android sparse images instead of raw "
+                             "partition images")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of partitions to extract concurrently "
+                             "(default: number of CPUs)")
+    parser.add_argument("image", help="GPT disk image")
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        sector_size = args.sector_size or detect_sector_size(f)
+        partitions = read_partitions(f, sector_size)
+
+        def extract(partition):
+            start = partition.first_lba * sector_size
+            length = (partition.last_lba - partition.first_lba + 1) * \
+                sector_size
+            output = os.path.join(
+                args.output_dir,
+                f"{os.path.basename(args.image)}{partition.number}")
+            if args.android_sparse:
+                data_bytes = extract_android_sparse(f.fileno(), start, length,
+                                                    output, sector_size)
+            else:
+                data_bytes = extract_raw(f.fileno(), start, length, output)
+            print(f"{output}: {length} bytes ({partition.name}), "
+                  f"{data_bytes} bytes of data", flush=True)
+
+        jobs = max(1, min(args.jobs, len(partitions)))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for _ in executor.map(extract, partitions):
+                pass
+
+
+if __name__ == "__main__":
+    main()
@@ -13,24 +13,72 @@
 # Example:
 #   $ python3 get-rawprogram-filename.py rootfs rawprogram0.xml
 #   disk-ufs.img2
+#
+# Several labels may be looked up in several files at once with --label;
+# each file is parsed once and the results are printed as one line per file
+# with the file and the filenames in label order, separated by tabs, or as a
+# JSON object mapping each file to a label -> filename object.
+#
+# Usage:  get-rawprogram-filename.py --label <label> [--label <label>...]
+#             [--format tsv|json] <rawprogram.xml>...
+#
+# Example:
+#   $ python3 get-rawprogram-filename.py --label efi --label rootfs \
+#         flash_*/rawprogram0.xml
+#   flash_qcs6490-rb3gen2_ufs/rawprogram0.xml	disk-ufs.img1	disk-ufs.img2
 
+import argparse
+import json
 import sys
-import defusedxml.ElementTree as ET
 
-if len(sys.argv) != 3:
-    print(f"Usage: {sys.argv[0]} <label> <rawprogram0.xml>", file=sys.stderr)
-    sys.exit(1)
+from rawprogram import program_filenames
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage=(
+            "%(prog)s <label> <rawprogram0.xml>\n"
+            "       %(prog)s --label <label> [--label <label>...] "
+            "[--format tsv|json] <rawprogram.xml>..."
+        )
+    )
+    parser.add_argument(
+        "--label",
+        action="append",
+        dest="labels",
+        help="label to look up; may be repeated",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["tsv", "json"],
+        default="tsv",
+        help="output format with --label (default: tsv)",
+    )
+    parser.add_argument("args", nargs="+", metavar="ARG")
+    args = parser.parse_args()
+
+    if args.labels is None:
+        if len(args.args) != 2:
+            parser.print_usage(sys.stderr)
+            sys.exit(1)
+        label, xml_file = args.args
+        print(program_filenames(xml_file).get(label, "none"))
+        return
+
+    results = {}
+    for xml_file in args.args:
+        filenames = program_filenames(xml_file)
+        results[xml_file] = {
+            label: filenames.get(label, "none") for label in args.labels
+        }
 
-label, xml_file = sys.argv[1], sys.argv[2]
+    if args.format == "json":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for xml_file, filenames in results.items():
+            print("\t".join([xml_file] + list(filenames.values())))
 
-root = ET.parse(xml_file).getroot()
-e = root.find(f".//program[@label='{label}']")
-if e is None:
-    print("none")
-    sys.exit(0)
 
-filename = e.get("filename")
-# Strip any leading ../ path components
-while filename.startswith("../"):
-    filename = filename[3:]
-print(filename)
+if __name__ == "__main__":
+    main()
@@ -5,23 +5,46 @@
 # input is a Grype JSON file as the first argument; output is a
 # human-readable summary of the vulnerabilities found, in Markdown format
 # suitable for a GitHub job summary
+#
+# several Grype JSON files, e.g. one per image, may be passed at once; they
+# are then summarized concurrently and merged in a single report with one
+# column per image, listing vulnerabilities shared by several images once
+#
+# --save-baseline stores a compact snapshot of the vulnerabilities found;
+# with --baseline, only the vulnerabilities that are new, resolved or
+# changed severity since that snapshot are reported
+#
+# the Grype JSON may be gzip or zstd compressed; its matches are read one at
+# a time, so memory use grows with the number of vulnerabilities rather than
+# with the document size
 
-import json
 import argparse
-from collections import defaultdict
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from jsonstream import iter_json_array, open_json
 
 # severities in reporting order; anything Grype reports that isn't in this
 # list is collected under "Unknown"
 SEVERITIES = ["Critical", "High", "Medium", "Low", "Negligible", "Unknown"]
 
+# version of the --save-baseline snapshot format
+SNAPSHOT_VERSION = 1
+
 # only vulnerabilities at or above this severity are listed individually; the
 # others are only counted, to keep the summary readable
 DETAIL_SEVERITIES = ["Critical", "High"]
 
 
-def load_grype_json(file_path):
-    with open(file_path, 'r') as f:
-        return json.load(f)
+def iter_grype_matches(file_path, data):
+    """
+    Yield the matches of a Grype JSON file one at a time; the other
+    top-level members, e.g. distro and descriptor, are stored in data.
+    """
+    return iter_json_array(file_path, "matches", data)
 
 
 def normalize_severity(severity):
@@ -29,31 +52,111 @@ def normalize_severity(severity):
     return severity if severity in SEVERITIES else "Unknown"
 
 
-def collect_matches(data):
+class Vulnerability:
+    """
+    Affected packages and fix information of a vulnerability; slotted to
+    keep the per-vulnerability overhead low on large reports.
+    """
+    __slots__ = ("packages", "fix_versions", "fix_state")
+
+    def __init__(self):
+        self.packages = set()
+        self.fix_versions = set()
+        self.fix_state = set()
+
+
+def collect_matches(matches):
     # a single CVE can match several binary packages built from the same
     # source package, so group by (severity, vulnerability) and collect the
-    # affected packages
-    grouped = defaultdict(lambda: {
-        "packages": set(),
-        "fix_versions": set(),
-        "fix_state": set()
-    })
-    for match in data.get("matches", []):
+    # affected packages; package names, versions and fix states repeat
+    # heavily across vulnerabilities, so intern them
+    intern = sys.intern
+    grouped = defaultdict(Vulnerability)
+    for match in matches:
         vulnerability = match.get("vulnerability", {})
         artifact = match.get("artifact", {})
         vuln_id = vulnerability.get("id", "unknown")
         severity = normalize_severity(vulnerability.get("severity"))
-        key = (severity, vuln_id)
+        entry = grouped[(severity, vuln_id)]
         name = artifact.get("name", "unknown")
         version = artifact.get("version", "")
-        grouped[key]["packages"].add(f"{name} {version}".strip())
+        package = f"{name} {version}".strip()
+        if package not in entry.packages:
+            entry.packages.add(intern(package))
         fix = vulnerability.get("fix", {})
-        grouped[key]["fix_state"].add(fix.get("state", "unknown"))
+        state = fix.get("state", "unknown")
+        if state not in entry.fix_state:
+            entry.fix_state.add(intern(state))
         for fix_version in fix.get("versions", []):
-            grouped[key]["fix_versions"].add(fix_version)
+            if fix_version not in entry.fix_versions:
+                entry.fix_versions.add(intern(fix_version))
     return grouped
 
 
+def summarize_file(file_path):
+    """
+    Return the grouped matches and the other top-level members of a Grype
+    JSON file.
+    """
+    data = {}
+    grouped = collect_matches(iter_grype_matches(file_path, data))
+    return dict(grouped), data
+
+
+def image_label(file_path):
+    """Derive a short image name from the path of a Grype JSON file."""
+    name = os.path.basename(file_path)
+    for suffix in (".gz", ".zst", ".json", ".grype"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def image_labels(file_paths):
+    """
+    Derive unique image names from the paths of Grype JSON files; names
+    which would collide are prefixed with as many parent directories as
+    needed to tell them apart.
+    """
+    labels = [image_label(path) for path in file_paths]
+    parents = [os.path.normpath(os.path.dirname(os.path.abspath(path)))
+               for path in file_paths]
+    depth = 0
+    while True:
+        counts = Counter(labels)
+        colliding = [i for i, label in enumerate(labels) if counts[label] > 1]
+        if not colliding:
+            return labels
+        depth += 1
+        for i in colliding:
+            name = image_label(file_paths[i])
+            parts = parents[i].strip(os.sep).split(os.sep)
+            if depth > len(parts):
+                sys.exit(f"Cannot tell {file_paths[i]} apart from the other "
+                         f"reports named {name}")
+            labels[i] = "/".join(parts[-depth:] + [name])
+
+
+def detailed_keys(grouped):
+    return sorted(
+        (key for key in grouped if key[0] in DETAIL_SEVERITIES),
+        key=lambda key: (DETAIL_SEVERITIES.index(key[0]), key[1])
+    )
+
+
+def format_fix(entry):
+    if entry.fix_versions:
+        return ", ".join(sorted(entry.fix_versions))
+    return ", ".join(sorted(entry.fix_state))
+
+
+def describe_distro(data):
+    distro = data.get("distro", {})
+    distro_name = distro.get("name", "unknown")
+    distro_version = distro.get("version") or distro.get("idLike") or ""
+    return f"{distro_name} {distro_version}".rstrip()
+
+
 def count_by_severity(grouped):
     counts = defaultdict(int)
     for severity, _ in grouped:
@@ -63,14 +166,11 @@ def count_by_severity(grouped):
 
 def print_summary(grouped, data):
     counts = count_by_severity(grouped)
-    distro = data.get("distro", {})
-    distro_name = distro.get("name", "unknown")
-    distro_version = distro.get("version") or distro.get("idLike") or ""
     db = data.get("descriptor", {}).get("db", {})
 
     print("## Vulnerability summary (Grype)")
     print()
-    print(f"Distribution: `{distro_name} {distro_version}`".rstrip() + "  ")
+    print(f"Distribution: `{describe_distro(data)}`  ")
     print(f"Vulnerability database built: "
           f"`{db.get('built', 'unknown')}`  ")
     print(f"Total unique vulnerabilities: **{len(grouped)}**")
@@ -82,10 +182,7 @@ def print_summary(grouped, data):
         print(f"| {severity} | {counts[severity]} |")
     print()
 
-    detailed = sorted(
-        (key for key in grouped if key[0] in DETAIL_SEVERITIES),
-        key=lambda key: (DETAIL_SEVERITIES.index(key[0]), key[1])
-    )
+    detailed = detailed_keys(grouped)
     if not detailed:
         print(f"No {' or '.join(DETAIL_SEVERITIES).lower()} "
               "severity vulnerabilities found.")
@@ -97,20 +194,212 @@ def print_summary(grouped, data):
     print("| --- | --- | --- | --- |")
     for severity, vuln_id in detailed:
         entry = grouped[(severity, vuln_id)]
-        packages = ", ".join(sorted(entry["packages"]))
-        if entry["fix_versions"]:
-            fix = ", ".join(sorted(entry["fix_versions"]))
-        else:
-            fix = ", ".join(sorted(entry["fix_state"]))
+        packages = ", ".join(sorted(entry.packages))
+        fix = format_fix(entry)
         print(f"| {severity} | {vuln_id} | {packages} | {fix} |")
 
 
+def merge_grouped(groups):
+    """
+    Merge the grouped matches of several images; return the merged entries
+    and, for each (severity, vulnerability), the indices of the images it
+    was found in.
+    """
+    merged = defaultdict(Vulnerability)
+    found_in = defaultdict(list)
+    for i, grouped in enumerate(groups):
+        for key, entry in grouped.items():
+            merged_entry = merged[key]
+            merged_entry.packages |= entry.packages
+            merged_entry.fix_versions |= entry.fix_versions
+            merged_entry.fix_state |= entry.fix_state
+            found_in[key].append(i)
+    return merged, found_in
+
+
+def print_merged_summary(results):
+    """
+    Print a single report for several images; results is a list of
+    (label, grouped, data) tuples.
+    """
+    labels = [label for label, _, _ in results]
+    merged, found_in = merge_grouped([grouped for _, grouped, _ in results])
+    image_columns = " | ".join(labels)
+    separators = " | ".join("---" for _ in labels)
+
+    print("## Vulnerability summary (Grype)")
+    print()
+    print("| Image | Distribution | Vulnerability database built "
+          "| Unique vulnerabilities |")
+    print("| --- | --- | --- | --- |")
+    for label, grouped, data in results:
+        db = data.get("descriptor", {}).get("db", {})
+        print(f"| {label} | `{describe_distro(data)}` "
+              f"| `{db.get('built', 'unknown')}` | {len(grouped)} |")
+    print()
+    shared = sum(1 for images in found_in.values() if len(images) > 1)
+    print(f"Total unique vulnerabilities across images: **{len(merged)}** "
+          f"({shared} found in several images)")
+    print()
+
+    all_counts = [count_by_severity(grouped) for _, grouped, _ in results]
+    merged_counts = count_by_severity(merged)
+    print(f"| Severity | {image_columns} | All images |")
+    print(f"| --- | {separators} | --- |")
+    for severity in SEVERITIES:
+        per_image = " | ".join(str(counts[severity]) for counts in all_counts)
+        print(f"| {severity} | {per_image} | {merged_counts[severity]} |")
+    print()
+
+    detailed = detailed_keys(merged)
+    if not detailed:
+        print(f"No {' or '.join(DETAIL_SEVERITIES).lower()} "
+              "severity vulnerabilities found.")
+        return
+
+    print(f"### {' and '.join(DETAIL_SEVERITIES)} severity vulnerabilities")
+    print()
+    print(f"| Severity | Vulnerability | Packages | Fixed in "
+          f"| {image_columns} |")
+    print(f"| --- | --- | --- | --- | {separators} |")
+    for severity, vuln_id in detailed:
+        key = (severity, vuln_id)
+        entry = merged[key]
+        packages = ", ".join(sorted(entry.packages))
+        fix = format_fix(entry)
+        marks = " | ".join(
+            "✓" if i in found_in[key] else "" for i in range(len(labels)))
+        print(f"| {severity} | {vuln_id} | {packages} | {fix} | {marks} |")
+
+
+def make_snapshot(grouped):
+    """
+    Index grouped matches by vulnerability id; each id maps to a
+    [severity, packages, fix] list. When Grype reports several severities
+    for one id, the most severe one is kept.
+    """
+    severities = {}
+    entries = defaultdict(Vulnerability)
+    for (severity, vuln_id), entry in grouped.items():
+        current = severities.get(vuln_id)
+        if (current is None
+                or SEVERITIES.index(severity) < SEVERITIES.index(current)):
+            severities[vuln_id] = severity
+        merged_entry = entries[vuln_id]
+        merged_entry.packages |= entry.packages
+        merged_entry.fix_versions |= entry.fix_versions
+        merged_entry.fix_state |= entry.fix_state
+    return {
+        vuln_id: [severities[vuln_id], sorted(entry.packages),
+                  format_fix(entry)]
+        for vuln_id, entry in entries.items()
+    }
+
+
+def save_snapshot(snapshot, path):
+    with open(path, 'w') as f:
+        json.dump({"version": SNAPSHOT_VERSION,
+                   "vulnerabilities": snapshot}, f,
+                  separators=(",", ":"), sort_keys=True)
+
+
+def load_snapshot(path):
+    with open_json(path) as f:
+        data = json.load(f)
+    if data.get("version") != SNAPSHOT_VERSION:
+        sys.exit(f"Unsupported baseline snapshot version in {path}")
+    return data["vulnerabilities"]
+
+
+def diff_snapshots(old, new):
+    """
+    Return the (new, resolved, changed) vulnerability ids between two
+    snapshots; changed lists the ids whose severity differs.
+    """
+    added = [vuln_id for vuln_id in new if vuln_id not in old]
+    resolved = [vuln_id for vuln_id in old if vuln_id not in new]
+    changed = [vuln_id for vuln_id in new
+               if vuln_id in old and old[vuln_id][0] != new[vuln_id][0]]
+    return added, resolved, changed
+
+
+def print_changes(old, new):
+    added, resolved, changed = diff_snapshots(old, new)
+
+    def by_severity(snapshot):
+        return lambda vuln_id: (SEVERITIES.index(snapshot[vuln_id][0]),
+                                vuln_id)
+
+    print("## Vulnerability changes since baseline (Grype)")
+    print()
+    print(f"New: **{len(added)}**, resolved: **{len(resolved)}**, "
+          f"severity changed: **{len(changed)}**")
+    print()
+
+    for title, ids, snapshot in (("New", added, new),
+                                 ("Resolved", resolved, old)):
+        if not ids:
+            continue
+        print(f"### {title} vulnerabilities")
+        print()
+        print("| Severity | Vulnerability | Packages | Fixed in |")
+        print("| --- | --- | --- | --- |")
+        for vuln_id in sorted(ids, key=by_severity(snapshot)):
+            severity, packages, fix = snapshot[vuln_id]
+            print(f"| {severity} | {vuln_id} | {', '.join(packages)} "
+                  f"| {fix} |")
+        print()
+
+    if changed:
+        print("### Vulnerabilities with a new severity")
+        print()
+        print("| Vulnerability | Previous severity | Severity | Packages |")
+        print("| --- | --- | --- | --- |")
+        for vuln_id in sorted(changed, key=by_severity(new)):
+            severity, packages, _ = new[vuln_id]
+            print(f"| {vuln_id} | {old[vuln_id][0]} | {severity} "
+                  f"| {', '.join(packages)} |")
+        print()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
                  description="Summarize Grype vulnerability data.")
-    parser.add_argument("grype_json", help="Path to the Grype JSON file")
+    parser.add_argument("grype_json", nargs="+",
+                        help="Path to the Grype JSON file; several files "
+                             "are merged in a single report")
+    parser.add_argument("--baseline",
+                        help="Only report the changes since this snapshot, "
+                             "as saved by --save-baseline")
+    parser.add_argument("--save-baseline",
+                        help="Save a snapshot of the vulnerabilities found "
+                             "to this file")
     args = parser.parse_args()
 
-    grype_data = load_grype_json(args.grype_json)
-    grype_grouped = collect_matches(grype_data)
-    print_summary(grype_grouped, grype_data)
+    if len(args.grype_json) == 1:
+        grype_grouped, grype_data = summarize_file(args.grype_json[0])
+        results = None
+    else:
+        # labels only depend on the paths, check them before parsing
+        labels = image_labels(args.grype_json)
+        with ProcessPoolExecutor(
+                max_workers=min(len(args.grype_json),
+                                os.cpu_count() or 1)) as executor:
+            summaries = list(executor.map(summarize_file, args.grype_json))
+        results = [
+            (label, grouped, data)
+            for label, (grouped, data) in zip(labels, summaries)
+        ]
+        grype_grouped, _ = merge_grouped(
+            [grouped for _, grouped, _ in results])
+
+    grype_snapshot = make_snapshot(grype_grouped)
+    if args.baseline:
+        print_changes(load_snapshot(args.baseline), grype_snapshot)
+    elif results is None:
+        print_summary(grype_grouped, grype_data)
+    else:
+        print_merged_summary(results)
+
+    if args.save_baseline:
+        save_snapshot(grype_snapshot, args.save_baseline)
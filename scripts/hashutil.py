@@ -0,0 +1,71 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Helpers to hash files with a flat memory footprint, shared by the scripts
+# in this directory; files are read in fixed-size chunks (or through mmap
+# for large files) rather than loaded whole, and many files can be hashed
+# concurrently through a bounded thread pool
+
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# size of the chunks fed to the hash function
+CHUNK_SIZE = 1024 * 1024
+# files at least this large are hashed through mmap, which saves copying
+# their contents to a userspace buffer
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# upper bound for the number of files hashed concurrently; hashlib releases
+# the GIL on large updates so threads do run in parallel
+MAX_WORKERS = 8
+
+
+def file_digest(path, algorithm='sha256'):
+    """
+    Return the hex digest of the file at path.
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(m)
+                try:
+                    for offset in range(0, size, CHUNK_SIZE):
+                        h.update(view[offset:offset + CHUNK_SIZE])
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(CHUNK_SIZE)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+def digest_files(paths, algorithm='sha256', max_workers=None):
+    """
+    Hash several files concurrently; return a dict mapping each unique path
+    to its hex digest, or to None when the file could not be read.
+    """
+    def digest_or_none(path):
+        try:
+            return file_digest(path, algorithm)
+        except OSError:
+            return None
+
+    unique_paths = list(dict.fromkeys(paths))
+    if max_workers is None:
+        max_workers = min(MAX_WORKERS, os.cpu_count() or 1)
+    max_workers = max(1, min(max_workers, len(unique_paths)))
+    if max_workers == 1:
+        return {path: digest_or_none(path) for path in unique_paths}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(unique_paths,
+                        executor.map(digest_or_none, unique_paths)))
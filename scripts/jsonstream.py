@@ -0,0 +1,161 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Incremental reader for large JSON documents such as Syft SBOMs and Grype
+# reports, shared by the scripts in this directory; the elements of one
+# top-level array are decoded and handed out one at a time, so that peak
+# memory doesn't grow with the document size. gzip and zstd compressed
+# documents are decompressed on the fly.
+
+import gzip
+import io
+import json
+import signal
+import subprocess
+
+# number of characters read from the document at a time
+CHUNK_SIZE = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+WHITESPACE = ' \t\n\r'
+
+
+class _ProcessOutput(io.TextIOWrapper):
+    """
+    Text output of a decompression process; closing it waits for the
+    process and raises OSError if it failed.
+    """
+
+    def __init__(self, proc):
+        super().__init__(proc.stdout, encoding='utf-8')
+        self.proc = proc
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        returncode = self.proc.wait()
+        # SIGPIPE only means the output was closed before the end
+        if returncode and returncode != -signal.SIGPIPE:
+            raise OSError(
+                f"{' '.join(self.proc.args)} failed with status {returncode}")
+
+
+def open_json(path):
+    """
+    Open a JSON document for reading as text, transparently decompressing
+    gzip and zstd input.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if magic == ZSTD_MAGIC:
+        try:
+            from compression import zstd  # pylint: disable=import-error
+            return zstd.open(path, 'rt', encoding='utf-8')
+        except ImportError:
+            pass
+        # Python < 3.14 has no zstd module; use the zstd command instead
+        try:
+            proc = subprocess.Popen(['zstd', '-dc', path],
+                                    stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            raise OSError(f"Cannot decompress {path}: install zstd or use "
+                          "Python >= 3.14") from None
+        return _ProcessOutput(proc)
+    return open(path, 'r', encoding='utf-8')
+
+
+class _Reader:
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size=CHUNK_SIZE):
+        # drop what was already consumed before growing the buffer
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+        self.buf += data
+
+    def peek(self):
+        while True:
+            while (self.pos < len(self.buf)
+                   and self.buf[self.pos] in WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON document")
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                f"Expected {char!r} in JSON document, got {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        size = CHUNK_SIZE
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer might continue in the
+                # next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read more at once as the value grows, to keep the number of
+            # decoding attempts logarithmic
+            self.fill(size)
+            size = max(size, len(self.buf))
+
+
+def iter_json_array(path, key, members=None):
+    """
+    Yield the elements of the top-level key array of the JSON document at
+    path, one at a time. The other top-level members are stored in the
+    members dict, if set, as they are read; other top-level arrays are
+    skipped without being kept in memory.
+    """
+    with open_json(path) as f:
+        reader = _Reader(f)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if reader.peek() == '[':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        element = reader.value()
+                        if name == key:
+                            yield element
+                        if reader.peek() == ']':
+                            reader.pos += 1
+                            break
+                        reader.expect(',')
+            else:
+                value = reader.value()
+                if members is not None:
+                    members[name] = value
+            if reader.peek() == '}':
+                return
+            reader.expect(',')
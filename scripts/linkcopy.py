@@ -0,0 +1,168 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# File copies sharing their data where possible, shared by the scripts in
+# this directory; files with the same contents are hardlinked to the first
+# copy installed, and copies are reflinked on filesystems supporting it
+# (btrfs, XFS...), falling back to a regular copy otherwise.
+#
+# Since hardlinked files share their data, files installed this way must be
+# replaced (e.g. with replace_file()) rather than modified in place.
+
+import fcntl
+import os
+import secrets
+import shutil
+import threading
+
+from hashutil import file_digest
+
+# ioctl sharing the data of a file with another one, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _temp_path(path):
+    """Return an unused temporary path in the directory of path"""
+    head, tail = os.path.split(path)
+    return os.path.join(head, f".{tail}.{secrets.token_hex(4)}.tmp")
+
+
+def replace_file(path, write):
+    """
+    Replace the file at path with a new file written by write(f), with the
+    same mode and timestamps, without modifying the data of any hardlink
+    to the original file.
+    """
+    tmp = _temp_path(path)
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def clone_file(src, dst):
+    """
+    Copy src to dst along with its mode and timestamps, through a reflink
+    when the filesystem supports it; an existing dst is replaced rather than
+    written to.
+    """
+    tmp = _temp_path(dst)
+    try:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                cloned = True
+            except OSError:
+                # other filesystem or no reflink support
+                cloned = False
+        if not cloned:
+            shutil.copyfile(src, tmp)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def link_file(src, dst):
+    """Hardlink dst to src, replacing any existing dst"""
+    tmp = _temp_path(dst)
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class Deduplicator:
+    """
+    Install files, hardlinking the files with the same contents to the
+    first copy installed; thread-safe. bytes_copied and bytes_linked count
+    the data which was copied and which was shared with an earlier copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # digests by (st_dev, st_ino, st_size, st_mtime_ns)
+        self._digests = {}
+        # first copy by (size, digest), as [lock, (path, st_dev, st_ino)]
+        self._copies = {}
+        self.files_copied = 0
+        self.files_linked = 0
+        self.bytes_copied = 0
+        self.bytes_linked = 0
+
+    def _digest(self, path, st):
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+
+    def _count(self, size, linked):
+        with self._lock:
+            if linked:
+                self.files_linked += 1
+                self.bytes_linked += size
+            else:
+                self.files_copied += 1
+                self.bytes_copied += size
+
+    def install(self, src, dst):
+        """Install a copy of the file src at dst, replacing any dst"""
+        st = os.stat(src)
+        digest = self._digest(src, st)
+        with self._lock:
+            entry = self._copies.setdefault((st.st_size, digest),
+                                            [threading.Lock(), None])
+        with entry[0]:
+            first = entry[1]
+            if first is not None:
+                path, dev, ino = first
+                try:
+                    link_file(path, dst)
+                    linked = os.stat(dst)
+                except OSError:
+                    # removed, other filesystem or too many links
+                    linked = None
+                # the first copy might have been replaced since
+                if linked and (linked.st_dev, linked.st_ino) == (dev, ino):
+                    self._count(st.st_size, linked=True)
+                    return
+            clone_file(src, dst)
+            self._count(st.st_size, linked=False)
+            if first is None:
+                copy = os.stat(dst)
+                entry[1] = (dst, copy.st_dev, copy.st_ino)
+                with self._lock:
+                    self._digests[(copy.st_dev, copy.st_ino, copy.st_size,
+                                   copy.st_mtime_ns)] = digest
+
+    def install_tree(self, src, dst):
+        """
+        Install the files of the directory src into dst, merging them with
+        any existing tree like cp -a src/. dst/
+        """
+        for root, dirs, files in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(target, exist_ok=True)
+            shutil.copystat(root, target)
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                target_path = os.path.join(target, name)
+                if os.path.islink(path):
+                    if os.path.lexists(target_path):
+                        os.unlink(target_path)
+                    os.symlink(os.readlink(path), target_path)
+                elif name in files:
+                    self.install(path, target_path)
@@ -0,0 +1,330 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Pool of reusable QEMU disk overlays, shared by run-qemu.py and the QEMU
+# tests; the base image is booted once up to its login prompt and the whole
+# VM state is saved with savevm as an internal snapshot of a qcow2 overlay.
+# VMs then start from a copy of that overlay with -loadvm, skipping the
+# first boot, and the copies are reverted to the snapshot to be reused.
+#
+# Pool entries are keyed by the SHA256 of the base image and by the QEMU
+# command line, which has to stay the same for the saved state to load;
+# entries for previous contents of the same base image are removed. The
+# QEMU command must have its serial console on stdio (e.g. -nographic).
+
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import platform
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from hashutil import file_digest
+
+# name of the internal snapshot holding the booted VM state
+SNAPSHOT = "booted"
+# printed on the serial console once the system is booted
+LOGIN_PROMPT = b" login:"
+
+
+class QMPError(Exception):
+    pass
+
+
+class QMP:
+    """Minimal QEMU Machine Protocol client over a UNIX socket"""
+
+    def __init__(self, path, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.file = self.sock.makefile("rwb")
+        # greeting
+        self._read()
+        self.execute("qmp_capabilities")
+
+    def _read(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("QMP connection closed")
+        return json.loads(line)
+
+    def execute(self, command, **arguments):
+        request = {"execute": command}
+        if arguments:
+            request["arguments"] = arguments
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        while True:
+            message = self._read()
+            if "return" in message:
+                return message["return"]
+            if "error" in message:
+                raise QMPError(message["error"]["desc"])
+            # skip asynchronous events
+
+    def hmp(self, command_line):
+        """Run a human monitor command and return its output"""
+        return self.execute("human-monitor-command",
+                            **{"command-line": command_line})
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def wait_for_output(stream, pattern, timeout, log=None):
+    """
+    Read the output of a process from stream until pattern shows up,
+    copying it to the log binary file if set; raise TimeoutError after
+    timeout seconds and EOFError if the process exits.
+    """
+    deadline = time.monotonic() + timeout
+    tail = b""
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"{pattern!r} not found in {timeout}s")
+        ready, _, _ = select.select([stream], [], [], remaining)
+        if not ready:
+            continue
+        data = os.read(stream.fileno(), 65536)
+        if not data:
+            raise EOFError(f"Process exited before printing {pattern!r}")
+        if log:
+            log.write(data)
+            log.flush()
+        # the pattern might be split across reads
+        tail = tail[-len(pattern):] + data
+        if pattern in tail:
+            return
+
+
+def image_digest(path, cache_file):
+    """
+    Return the SHA256 of the image at path; digests are cached in
+    cache_file by path, size, inode and modification time, so that large
+    images are only hashed again when they change.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_ino, st.st_mtime_ns]
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    entry = cache.get(path)
+    if entry and entry["stamp"] == stamp:
+        return entry["sha256"]
+
+    digest = file_digest(path)
+    cache[path] = {"stamp": stamp, "sha256": digest}
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_file),
+                               suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp, cache_file)
+    return digest
+
+
+def available_memory_mib():
+    """Return the memory available to new processes, in MiB"""
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    # no /proc on macOS; fall back to the physical memory size
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2**20
+
+
+def max_instances(memory_mib, vcpus=1, overhead_mib=512):
+    """
+    Return how many VMs with memory_mib of RAM and vcpus vCPUs this host can
+    run concurrently without overcommitting its CPUs or memory; each QEMU
+    process needs about overhead_mib on top of the guest RAM.
+    """
+    by_cpus = (os.cpu_count() or 1) // vcpus
+    by_memory = available_memory_mib() // (memory_mib + overhead_mib)
+    return max(1, min(by_cpus, by_memory))
+
+
+def copy_image(src, dst):
+    """Copy a disk image, sharing its blocks where the filesystem can"""
+    if platform.system() == "Linux":
+        subprocess.run(["cp", "--reflink=auto", str(src), str(dst)],
+                       check=True)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def try_lock(path):
+    """Return the open lock file at path if it could be locked, or None"""
+    lock = open(path, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+class OverlayPool:
+    """
+    Overlays of base_image with its booted state; make_command(overlay)
+    returns the QEMU command line to run the VM with the qcow2 overlay as
+    its disk.
+    """
+
+    def __init__(self, pool_dir, base_image, make_command, boot_timeout=900,
+                 log=None):
+        self.pool_dir = Path(pool_dir).absolute()
+        self.base_image = os.path.abspath(base_image)
+        self.make_command = make_command
+        self.boot_timeout = boot_timeout
+        self.log = log
+        self.pool_dir.mkdir(parents=True, exist_ok=True)
+
+        digest = image_digest(self.base_image,
+                              self.pool_dir / "digests.json")
+        self.meta = {
+            "base_image": self.base_image,
+            "sha256": digest,
+            "command": make_command("OVERLAY"),
+        }
+        key = hashlib.sha256(
+            json.dumps(self.meta, sort_keys=True).encode()).hexdigest()
+        self.entry = self.pool_dir / key[:16]
+        self.golden = self.entry / "golden.qcow2"
+
+    def _remove_stale_entries(self):
+        """Remove the entries for previous contents of the base image"""
+        for entry in self.pool_dir.iterdir():
+            if entry == self.entry or not entry.is_dir():
+                continue
+            try:
+                with open(entry / "meta.json", "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if (meta.get("base_image") != self.base_image
+                    or meta.get("sha256") == self.meta["sha256"]):
+                continue
+            # skip entries which are in use
+            locks = [try_lock(lock) for lock in entry.glob("*.lock")]
+            try:
+                if all(locks):
+                    print(f"Removing stale overlays {entry}",
+                          file=sys.stderr)
+                    shutil.rmtree(entry, ignore_errors=True)
+            finally:
+                for lock in locks:
+                    if lock:
+                        lock.close()
+
+    def _boot_and_save(self, overlay):
+        with tempfile.TemporaryDirectory(prefix="qemu-qmp-") as temp_dir:
+            qmp_path = os.path.join(temp_dir, "qmp.sock")
+            cmd = self.make_command(str(overlay)) + [
+                "-qmp", f"unix:{qmp_path},server=on,wait=off",
+            ]
+            print("Running:", " ".join(cmd), file=sys.stderr)
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE)
+            try:
+                wait_for_output(proc.stdout, LOGIN_PROMPT,
+                                self.boot_timeout, self.log)
+                qmp = QMP(qmp_path)
+                try:
+                    qmp.hmp(f"savevm {SNAPSHOT}")
+                    try:
+                        qmp.execute("quit")
+                    except ConnectionError:
+                        pass
+                finally:
+                    qmp.close()
+                proc.wait(timeout=60)
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+
+        # savevm reports errors as text only; check the snapshot is there
+        snapshots = subprocess.run(
+            ["qemu-img", "snapshot", "-l", str(overlay)],
+            stdout=subprocess.PIPE, text=True, check=True,
+        ).stdout.split()
+        if SNAPSHOT not in snapshots:
+            raise QMPError(f"Failed to save the VM state in {overlay}")
+
+    def ensure_golden(self):
+        """Boot the base image and save its state, unless already done"""
+        self.entry.mkdir(parents=True, exist_ok=True)
+        with open(self.entry / "golden.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.golden.exists():
+                return
+            self._remove_stale_entries()
+            print(f"Booting {self.base_image} to save its booted state",
+                  file=sys.stderr)
+            tmp = self.entry / "golden.qcow2.tmp"
+            subprocess.run(
+                ["qemu-img", "create", "-q", "-f", "qcow2", "-F", "raw",
+                 "-b", self.base_image, str(tmp)],
+                check=True,
+            )
+            self._boot_and_save(tmp)
+            with open(self.entry / "meta.json", "w", encoding="utf-8") as f:
+                json.dump(self.meta, f, indent=2)
+            os.replace(tmp, self.golden)
+
+    @contextmanager
+    def acquire(self):
+        """
+        Yield the path to an overlay, for exclusive use until the end of
+        the with block, with the booted state to start the VM with
+        -loadvm SNAPSHOT
+        """
+        self.ensure_golden()
+        for i in itertools.count():
+            lock = try_lock(self.entry / f"instance-{i}.lock")
+            if lock is None:
+                continue
+            with lock:
+                overlay = self.entry / f"instance-{i}.qcow2"
+                try:
+                    # drop the changes of the previous user
+                    subprocess.run(
+                        ["qemu-img", "snapshot", "-a", SNAPSHOT,
+                         str(overlay)],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        check=True,
+                    )
+                except subprocess.CalledProcessError:
+                    # missing or broken overlay
+                    tmp = overlay.with_suffix(".tmp")
+                    copy_image(self.golden, tmp)
+                    os.replace(tmp, overlay)
+                yield overlay
+            return
@@ -0,0 +1,26 @@
+# Copyright (c) Qualcomm Technologies, Inc. and/or its subsidiaries.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Lookup of the partition images in the rawprogram XML files generated by
+# qcom-ptool, shared by the scripts in this directory
+
+import defusedxml.ElementTree as ET
+
+
+def program_filenames(xml_file):
+    """
+    Map the label of each <program> element of xml_file to its filename
+    attribute, stripped of leading "../"; the first element with a label
+    wins.
+    """
+    filenames = {}
+    for e in ET.parse(xml_file).getroot().iter("program"):
+        label = e.get("label")
+        if label is None or label in filenames:
+            continue
+        filename = e.get("filename", "")
+        # Strip any leading ../ path components
+        while filename.startswith("../"):
+            filename = filename[3:]
+        filenames[label] = filename
+    return filenames
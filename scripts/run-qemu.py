@@ -15,21 +15,39 @@ Usage:
 
 - Disable COW overlay (write to disk image):
     run-qemu.py --no-cow
+
+- Resume from a saved booted state, booting the image only once:
+    run-qemu.py --headless --pool-dir ~/.cache/qcom-deb-images/qemu
+
+- Boot faster with KVM/HVF when available, or multi-threaded TCG, several
+  vCPUs and a virtio-blk disk; headless runs print the time to login:
+    run-qemu.py --profile fast --headless
 """
 
 import argparse
+import functools
 import os
 import sys
 import shutil
 import subprocess
 import tempfile
+import time
 import platform
 import shlex
-from typing import Optional
+from typing import List, Optional
+
+import qemupool
 
 DEFAULT_UFS_IMAGE = "disk-ufs.img"
 DEFAULT_SDCARD_IMAGE = "disk-sdcard.img"
 
+# upper bound for the number of vCPUs of the fast profile; more doesn't
+# speed up booting
+MAX_SMP = 8
+
+# printed on the serial console once the system is booted
+LOGIN_PROMPT = b" login:"
+
 
 def find_bios_path() -> Optional[str]:
     """
@@ -72,6 +90,252 @@ def find_bios_path() -> Optional[str]:
     return None
 
 
+def detect_accelerator() -> Optional[str]:
+    """
+    Get the hardware accelerator usable to run aarch64 guests on this host,
+    if any
+    """
+    if platform.machine().lower() not in ("aarch64", "arm64"):
+        return None
+    system = platform.system()
+    if system == "Linux":
+        if os.access("/dev/kvm", os.R_OK | os.W_OK):
+            return "kvm"
+    elif system == "Darwin":
+        completed = subprocess.run(
+            ["sysctl", "-n", "kern.hv_support"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        if completed.stdout.strip() == "1":
+            return "hvf"
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def io_uring_available(qemu: str = "qemu-system-aarch64") -> bool:
+    """
+    Whether QEMU can use io_uring for disk I/O on this host; both the kernel
+    and the QEMU build (which needs liburing) have to support it
+    """
+    if platform.system() != "Linux":
+        return False
+    # 2 means disabled for all processes; the sysctl only exists since
+    # Linux 6.6, assume io_uring is available on older kernels
+    try:
+        with open("/proc/sys/kernel/io_uring_disabled") as f:
+            if f.read().strip() == "2":
+                return False
+    except OSError:
+        pass
+    # QEMU builds without liburing refuse aio=io_uring at startup; open a
+    # throwaway block device with it and quit from the monitor. The file
+    # driver only accepts regular files, not e.g. /dev/null
+    try:
+        with tempfile.NamedTemporaryFile(prefix="qemu-io-uring-") as probe:
+            completed = subprocess.run(
+                [
+                    qemu,
+                    "-machine",
+                    "none",
+                    "-nodefaults",
+                    "-display",
+                    "none",
+                    "-monitor",
+                    "stdio",
+                    "-blockdev",
+                    "driver=file,filename="
+                    + probe.name.replace(",", ",,")
+                    + ",node-name=probe,read-only=on,aio=io_uring",
+                ],
+                input="quit\n",
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                timeout=30,
+            )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return completed.returncode == 0
+
+
+def guest_smp() -> int:
+    """
+    Number of vCPUs of the fast profile
+    """
+    return max(1, min(os.cpu_count() or 1, MAX_SMP))
+
+
+def fast_profile_args(
+    sector_size: int,
+    drive_file: str,
+    drive_format: str,
+    display_backend: str,
+    cow: bool,
+) -> List[str]:
+    """
+    QEMU arguments of the fast profile: hardware acceleration with the host
+    CPU or multi-threaded TCG, several vCPUs, a virtio-blk disk served by a
+    dedicated I/O thread, and virtio input devices instead of USB
+    """
+    accelerator = detect_accelerator()
+    smp = guest_smp()
+    args = []
+    if accelerator:
+        args += ["-accel", accelerator, "-cpu", "host"]
+    else:
+        # oldest supported CPU
+        args += ["-accel", "tcg,thread=multi", "-cpu", "cortex-a57"]
+
+    # the overlay is thrown away after the run, so there's no need to flush
+    # it to disk
+    cache = "unsafe" if cow else "writeback"
+    aio = "io_uring" if io_uring_available() else "threads"
+    args += [
+        "-smp",
+        str(smp),
+        # smallest memory size in all supported platforms
+        "-m",
+        "2048",
+        # GICv3 is required by KVM on most hosts and for more than 8 vCPUs
+        "-M",
+        "virt,gic-version=max",
+        "-object",
+        "iothread,id=iothread1",
+        "-drive",
+        f"if=none,file={drive_file},format={drive_format},id=disk1,"
+        f"cache={cache},aio={aio}",
+        "-device",
+        f"virtio-blk-pci,drive=disk1,iothread=iothread1,"
+        f"physical_block_size={sector_size},"
+        f"logical_block_size={sector_size}",
+        "-display",
+        display_backend,
+    ]
+    if display_backend != "none":
+        args += [
+            "-device",
+            "virtio-gpu-pci",
+            "-device",
+            "virtio-keyboard-pci",
+            "-device",
+            "virtio-tablet-pci",
+        ]
+    return args
+
+
+def run_timing_login(cmd: List[str]) -> int:
+    """
+    Run QEMU with the serial console on stdio, forwarding its output and
+    printing the time until the login prompt; return the exit status
+    """
+    sys.stdout.flush()
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    tail = b""
+    found = False
+    while True:
+        data = os.read(proc.stdout.fileno(), 65536)
+        if not data:
+            break
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+        if not found:
+            # the prompt might be split across reads
+            tail = tail[-len(LOGIN_PROMPT):] + data
+            if LOGIN_PROMPT in tail:
+                found = True
+                # the terminal is in raw mode
+                sys.stderr.write(
+                    f"\r\nTime to login prompt: "
+                    f"{time.monotonic() - start:.1f}s\r\n"
+                )
+    return proc.wait()
+
+
+def qemu_command(
+    args: argparse.Namespace,
+    sector_size: int,
+    drive_file: str,
+    drive_format: str,
+    display_backend: str,
+    bios_path: str,
+) -> List[str]:
+    """
+    QEMU command line to run the disk image drive_file
+    """
+    if args.profile == "fast":
+        cmd = ["qemu-system-aarch64"]
+        cmd += fast_profile_args(
+            sector_size,
+            drive_file,
+            drive_format,
+            display_backend,
+            not args.no_cow,
+        )
+        cmd += ["-bios", bios_path]
+    else:
+        cmd = [
+            "qemu-system-aarch64",
+            # oldest supported CPU
+            "-cpu",
+            "cortex-a57",
+            # smallest memory size in all supported platforms
+            "-m",
+            "2048",
+            # performant and complete model
+            "-M",
+            "virt",
+            "-device",
+            "virtio-gpu-pci",
+            "-display",
+            display_backend,
+            "-device",
+            "usb-ehci,id=ehci",
+            "-device",
+            "usb-kbd",
+            "-device",
+            "usb-mouse",
+            "-device",
+            "virtio-scsi-pci,id=scsi1",
+            "-device",
+            f"scsi-hd,bus=scsi1.0,drive=disk1,"
+            f"physical_block_size={sector_size},"
+            f"logical_block_size={sector_size}",
+            "-drive",
+            f"if=none,file={drive_file},format={drive_format},"
+            f"id=disk1",
+            "-bios",
+            bios_path,
+        ]
+
+    if args.headless:
+        cmd.extend(["-serial", "mon:stdio"])
+
+    if args.qemu_args:
+        cmd.extend(shlex.split(args.qemu_args))
+
+    return cmd
+
+
+def run_qemu(cmd: List[str], time_login: bool) -> None:
+    print("Running:", " ".join(cmd))
+    if time_login:
+        returncode = run_timing_login(cmd)
+        if returncode:
+            sys.stderr.write(
+                f"QEMU exited with error: status {returncode}\n"
+            )
+            sys.exit(returncode)
+        return
+    try:
+        subprocess.run(cmd, check=True)
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write(f"QEMU exited with error: {e}\n")
+        sys.exit(e.returncode)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=(
@@ -107,6 +371,25 @@ def main():
         action="store_true",
         help="Run without GUI; sets -display none and -serial mon:stdio.",
     )
+    parser.add_argument(
+        "--profile",
+        choices=["compat", "fast"],
+        default="compat",
+        help=(
+            "compat emulates the oldest supported CPU with SCSI and USB "
+            "devices; fast uses KVM or HVF with the host CPU when available "
+            "or multi-threaded TCG, several vCPUs and virtio-blk, and prints "
+            "the time to login in headless mode. Default is compat."
+        ),
+    )
+    parser.add_argument(
+        "--pool-dir",
+        help=(
+            "Directory of reusable overlays; the image is booted once to its "
+            "login prompt and the VM state is saved there, later runs resume "
+            "from it in a few seconds. Requires --headless."
+        ),
+    )
     parser.add_argument(
         "--qemu-args",
         dest="qemu_args",
@@ -117,6 +400,10 @@ def main():
     )
     args = parser.parse_args()
 
+    if args.pool_dir and (args.no_cow or not args.headless):
+        sys.stderr.write("--pool-dir requires --headless and the overlay\n")
+        sys.exit(2)
+
     # OS; "Linux" on Debian/Ubuntu, and "Darwin" on macOS; used to detect
     # defaults
     system = platform.system()
@@ -208,6 +495,37 @@ def main():
     if args.headless:
         display_backend = "none"
 
+    if args.profile == "fast":
+        accelerator = detect_accelerator()
+        if accelerator:
+            print(f"Using {accelerator} acceleration with {guest_smp()} vCPUs")
+        else:
+            print(f"Using multi-threaded TCG with {guest_smp()} vCPUs")
+
+    if args.pool_dir:
+        def make_command(overlay: str) -> List[str]:
+            return qemu_command(
+                args,
+                sector_size,
+                overlay,
+                "qcow2",
+                display_backend,
+                bios_path,
+            )
+
+        pool = qemupool.OverlayPool(
+            args.pool_dir, image_path, make_command, log=sys.stdout.buffer
+        )
+        with pool.acquire() as overlay:
+            cmd = make_command(str(overlay))
+            cmd.extend(["-loadvm", qemupool.SNAPSHOT])
+            sys.stderr.write(
+                "Resuming the booted system; press Enter for the login "
+                "prompt\n"
+            )
+            run_qemu(cmd, False)
+        return
+
     with tempfile.TemporaryDirectory(prefix="qemu-cow-") as temp_dir:
         # default to using the image as drive
         drive_file = image_path
@@ -236,53 +554,15 @@ def main():
             drive_file = overlay_path
             drive_format = "qcow2"
 
-        # run QEMU
-        cmd = [
-            "qemu-system-aarch64",
-            # oldest supported CPU
-            "-cpu",
-            "cortex-a57",
-            # smallest memory size in all supported platforms
-            "-m",
-            "2048",
-            # performant and complete model
-            "-M",
-            "virt",
-            "-device",
-            "virtio-gpu-pci",
-            "-display",
+        cmd = qemu_command(
+            args,
+            sector_size,
+            drive_file,
+            drive_format,
             display_backend,
-            "-device",
-            "usb-ehci,id=ehci",
-            "-device",
-            "usb-kbd",
-            "-device",
-            "usb-mouse",
-            "-device",
-            "virtio-scsi-pci,id=scsi1",
-            "-device",
-            f"scsi-hd,bus=scsi1.0,drive=disk1,"
-            f"physical_block_size={sector_size},"
-            f"logical_block_size={sector_size}",
-            "-drive",
-            f"if=none,file={drive_file},format={drive_format},"
-            f"id=disk1",
-            "-bios",
             bios_path,
-        ]
-
-        if args.headless:
-            cmd.extend(["-serial", "mon:stdio"])
-
-        if args.qemu_args:
-            cmd.extend(shlex.split(args.qemu_args))
-
-        print("Running:", " ".join(cmd))
-        try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            sys.stderr.write(f"QEMU exited with error: {e}\n")
-            sys.exit(e.returncode)
+        )
+        run_qemu(cmd, args.headless and args.profile == "fast")
 
 
 if __name__ == "__main__":
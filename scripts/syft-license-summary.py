@@ -5,61 +5,128 @@
 # input is a Syft JSON file as the first argument; output is a
 # human-readable summary of source packages and their licenses in CSV
 # format
+#
+# the Syft JSON may be gzip or zstd compressed; its artifacts are read one
+# at a time, so memory use grows with the number of source packages rather
+# than with the document size
 
 import json
-import hashlib
 import argparse
 import os
-from collections import defaultdict
+import sys
 
+from hashutil import digest_files
+from jsonstream import iter_json_array
 
-def load_syft_json(file_path):
-    with open(file_path, 'r') as f:
-        return json.load(f)
 
+def iter_syft_artifacts(file_path):
+    return iter_json_array(file_path, "artifacts")
 
-def sha256_of_file(path):
-    try:
-        with open(path, 'rb') as f:
-            return hashlib.sha256(f.read()).hexdigest()
-    except Exception:
-        return "unreadable"
 
+def hash_files(paths, cache_file=None):
+    """
+    Return a dict mapping each of paths to its sha256, hashing the unique
+    paths concurrently. If cache_file is set, digests are also looked up in
+    and saved to it, keyed by path, size, mtime and inode, so that an
+    unchanged rootfs doesn't need to be read again.
+    """
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
 
-def group_by_source_package(data):
-    grouped = defaultdict(lambda: {
-        "binaries": set(),
-        "licenses": set(),
-        "copyrights": {},
-        "source_version": None
-    })
-    for artifact in data.get("artifacts", []):
+    hashes = {}
+    keys = {}
+    to_hash = []
+    for path in dict.fromkeys(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            hashes[path] = "unreadable"
+            continue
+        key = f"{path}:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+        keys[path] = key
+        if key in cache:
+            hashes[path] = cache[key]
+        else:
+            to_hash.append(path)
+
+    for path, digest in digest_files(to_hash).items():
+        hashes[path] = digest or "unreadable"
+
+    if cache_file:
+        new_cache = {
+            key: hashes[path] for path, key in keys.items()
+            if hashes[path] != "unreadable"
+        }
+        with open(cache_file, 'w') as f:
+            json.dump(new_cache, f)
+    return hashes
+
+
+class SourcePackage:
+    """
+    Binaries, licenses and copyright files of a source package; slotted to
+    keep the per-package overhead low on large SBOMs.
+    """
+    __slots__ = ("binaries", "licenses", "copyrights", "source_version")
+
+    def __init__(self):
+        self.binaries = set()
+        self.licenses = set()
+        self.copyrights = {}
+        self.source_version = None
+
+
+def group_by_source_package(artifacts):
+    # binary names, versions and licenses repeat heavily across source
+    # packages; intern them so that each distinct string is stored once
+    intern = sys.intern
+    grouped = {}
+    for artifact in artifacts:
         metadata = artifact.get("metadata", {})
-        binary = metadata.get("package", "unknown")
+        binary = intern(metadata.get("package", "unknown"))
         source = metadata.get("source") or binary
         version = metadata.get("version", "")
         source_version = metadata.get("sourceVersion") or version
-        grouped[source]["binaries"].add(binary)
-        grouped[source]["source_version"] = source_version
+        entry = grouped.get(source)
+        if entry is None:
+            entry = grouped[source] = SourcePackage()
+        entry.binaries.add(binary)
+        if source_version != entry.source_version:
+            entry.source_version = intern(source_version)
         for lic in artifact.get("licenses", []):
-            grouped[source]["licenses"].add(lic.get("value", "unknown"))
+            value = lic.get("value", "unknown")
+            if value not in entry.licenses:
+                entry.licenses.add(intern(value))
         for loc in artifact.get("locations", []):
             path = loc.get("path", "")
-            if "copyright" in path:
-                grouped[source]["copyrights"][binary] = path
+            if "copyright" in path and entry.copyrights.get(binary) != path:
+                entry.copyrights[binary] = intern(path)
     return grouped
 
 
-def print_table(grouped, rootfs_path):
+def print_table(grouped, rootfs_path, hash_cache=None):
+    # the same copyright file is often shared by several binaries, so
+    # collect the unique paths first and hash them all at once
+    full_paths = {
+        path: os.path.join(rootfs_path, path.lstrip('/'))
+        for data in grouped.values()
+        for path in data.copyrights.values()
+    }
+    file_hashes = hash_files(full_paths.values(), hash_cache)
+
     print("source,version,binaries,licenses,copyright_sha256")
     for source, data in grouped.items():
-        binaries = " ".join(sorted(data["binaries"]))
-        licenses = " ".join(sorted(data["licenses"]))
-        version = data["source_version"] or "unknown"
-        hashes = set()
-        for path in data["copyrights"].values():
-            full_path = os.path.join(rootfs_path, path.lstrip('/'))
-            hashes.add(sha256_of_file(full_path))
+        binaries = " ".join(sorted(data.binaries))
+        licenses = " ".join(sorted(data.licenses))
+        version = data.source_version or "unknown"
+        hashes = set(
+            file_hashes[full_paths[path]]
+            for path in data.copyrights.values())
         hash_summary = " ".join(sorted(hashes))
         print(f"{source},{version},{binaries},{licenses},{hash_summary}")
 
@@ -70,8 +137,11 @@ if __name__ == "__main__":
     parser.add_argument("syft_json", help="Path to the Syft JSON file")
     parser.add_argument("--rootfs", required=True,
                         help="Base path to the root filesystem")
+    parser.add_argument("--hash-cache",
+                        help="Optional file where to cache the copyright "
+                             "file hashes across runs")
     args = parser.parse_args()
 
-    syft_data = load_syft_json(args.syft_json)
-    syft_grouped = group_by_source_package(syft_data)
-    print_table(syft_grouped, args.rootfs)
+    syft_grouped = group_by_source_package(
+        iter_syft_artifacts(args.syft_json))
+    print_table(syft_grouped, args.rootfs, args.hash_cache)